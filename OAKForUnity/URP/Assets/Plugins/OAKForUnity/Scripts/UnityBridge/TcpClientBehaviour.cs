@@ -18,6 +18,17 @@ public class TcpClientBehaviour : MonoBehaviour
 {
     public string host;
     public int port;
+    // Length-prefixed frames (magic, type, seq, timestamp, length) instead of the <<END>> sentinels
+    public bool useFrameHeader = false;
+    // Frame header only: also receive the color images when the bridge runs with --images
+    public bool requestImages = false;
+    // Frame header only, hub mode (hand_tracking_hub.py): serial numbers of the cameras to receive, empty for all
+    public string[] cameras = new string[0];
+    // Frame header only: hand fields to receive (e.g. "xyz", "label"), empty for all, and most hands, -1 for all
+    public string[] fields = new string[0];
+    public int maxHands = -1;
+    // Frame header only, bridge started with --prediction: hands extrapolated this many milliseconds ahead, 0 for none
+    public int predictMs = 0;
     
     private TcpClient client;
     private Thread clientThread;
@@ -36,6 +47,17 @@ public class TcpClientBehaviour : MonoBehaviour
     private int _getJson = 1;
     private const string DELIMITER = "<<END_OF_JSON>>";
     private const string DELIMITER_END = "<<END>>";
+
+    // Frame header, see unity_bridge_protocol.py
+    private const int HEADER_SIZE = 22;
+    private const int HEADER_TYPE_OFFSET = 3;
+    private const int HEADER_LENGTH_OFFSET = 18;
+    private const byte MSG_DATA = 1;
+    private const byte MSG_HELLO = 2;
+    private const byte MSG_IMAGE = 4;
+    private const byte MSG_STATUS = 5;
+    private byte[] _frameBuffer = new byte[64 * 1024];
+    private int _frameBufferCount = 0;
     void Start()
     {
         _connected = false;
@@ -48,6 +70,33 @@ public class TcpClientBehaviour : MonoBehaviour
         client.OnOpen(() =>
         {
             Debug.Log("Client connected");
+            if (useFrameHeader)
+            {
+                string images = requestImages ? "true" : "false";
+                string subscribed = "";
+                if (cameras != null && cameras.Length > 0)
+                {
+                    subscribed = ", \"cameras\": [\"" + string.Join("\", \"", cameras) + "\"]";
+                }
+                if (fields != null && fields.Length > 0)
+                {
+                    subscribed += ", \"fields\": [\"" + string.Join("\", \"", fields) + "\"]";
+                }
+                if (maxHands >= 0)
+                {
+                    subscribed += ", \"max_hands\": " + maxHands;
+                }
+                if (predictMs > 0)
+                {
+                    subscribed += ", \"predict_ms\": " + predictMs;
+                }
+                byte[] options = Encoding.UTF8.GetBytes("{\"framing\": \"header\", \"images\": " + images + subscribed + "}");
+                byte[] hello = new byte[8 + options.Length];
+                Encoding.ASCII.GetBytes("HELO", 0, 4, hello, 0);
+                Array.Copy(BitConverter.GetBytes((uint) options.Length), 0, hello, 4, 4);
+                Array.Copy(options, 0, hello, 8, options.Length);
+                client.ToData(hello);
+            }
             client.ToData("DATA");
             _connected = true;
         });
@@ -68,6 +117,11 @@ public class TcpClientBehaviour : MonoBehaviour
             // Remember to marshal this call back to the main thread if you're updating Unity objects
             //Debug.Log("GET JSON: "+_getJson);
             //Debug.Log("DATA: "+data.Length+" 0:"+data[0]);
+            if (useFrameHeader)
+            {
+                ReadFrames(data);
+                return;
+            }
             
             byte[] delimiterBytes = Encoding.ASCII.GetBytes(DELIMITER); 
             byte[] delimiterEndBytes = Encoding.ASCII.GetBytes(DELIMITER_END);
@@ -136,6 +190,58 @@ public class TcpClientBehaviour : MonoBehaviour
 
     }
 
+    // Append received bytes and handle every complete frame. Each frame is read by its exact length, no scanning.
+    void ReadFrames(byte[] data)
+    {
+        if (_frameBufferCount + data.Length > _frameBuffer.Length)
+        {
+            Array.Resize(ref _frameBuffer, Math.Max(_frameBuffer.Length * 2, _frameBufferCount + data.Length));
+        }
+        Buffer.BlockCopy(data, 0, _frameBuffer, _frameBufferCount, data.Length);
+        _frameBufferCount += data.Length;
+
+        int offset = 0;
+        while (_frameBufferCount - offset >= HEADER_SIZE)
+        {
+            if (_frameBuffer[offset] != (byte) 'U' || _frameBuffer[offset + 1] != (byte) 'B')
+            {
+                Debug.LogError("Invalid frame header, dropping received data");
+                _frameBufferCount = 0;
+                return;
+            }
+            byte msgType = _frameBuffer[offset + HEADER_TYPE_OFFSET];
+            int length = (int) BitConverter.ToUInt32(_frameBuffer, offset + HEADER_LENGTH_OFFSET);
+            if (_frameBufferCount - offset < HEADER_SIZE + length) break;
+
+            if (msgType == MSG_DATA)
+            {
+                byte[] payload = new byte[length];
+                Buffer.BlockCopy(_frameBuffer, offset + HEADER_SIZE, payload, 0, length);
+                _pendingJsonData = payload;
+            }
+            else if (msgType == MSG_IMAGE)
+            {
+                byte[] image = new byte[length];
+                Buffer.BlockCopy(_frameBuffer, offset + HEADER_SIZE, image, 0, length);
+                _pendingImageData = image;
+            }
+            else if (msgType == MSG_HELLO)
+            {
+                Debug.Log("Handshake: " + Encoding.UTF8.GetString(_frameBuffer, offset + HEADER_SIZE, length));
+            }
+            else if (msgType == MSG_STATUS)
+            {
+                // Startup readiness of the bridge: listening, streaming, first_inference
+                Debug.Log("Bridge status: " + Encoding.UTF8.GetString(_frameBuffer, offset + HEADER_SIZE, length));
+            }
+            offset += HEADER_SIZE + length;
+        }
+
+        // Keep the incomplete frame at the start of the buffer
+        Buffer.BlockCopy(_frameBuffer, offset, _frameBuffer, 0, _frameBufferCount - offset);
+        _frameBufferCount -= offset;
+    }
+
     // Helper method to find the delimiter in the data
     int FindDelimiterIndex(byte[] data, byte[] delimiter)
     {
@@ -163,6 +269,24 @@ public class TcpClientBehaviour : MonoBehaviour
     }
     private void Update()
     {
+        if (useFrameHeader)
+        {
+            if (_pendingImageData != null)
+            {
+                if (!_texture.LoadImage(_pendingImageData))
+                {
+                    Debug.LogError("Failed to create texture from received image data");
+                }
+                _pendingImageData = null;
+            }
+            if (_pendingJsonData != null)
+            {
+                _json = System.Text.Encoding.UTF8.GetString(_pendingJsonData);
+                _pendingJsonData = null;
+                client.ToData("DATA");
+            }
+            return;
+        }
         if (_pendingImageData != null && _getJson == 0)
         {
             if (!_texture.LoadImage(_pendingImageData))
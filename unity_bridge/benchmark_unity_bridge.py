@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+# Loopback benchmark of UnityBridge, no camera needed.
+#
+# Synthetic hands (0, 1 and 2 HandRegion objects per frame, as sent by
+# intel_hand_tracking_unity_bridge.py) go through:
+#   serialize  UnityBridge._serialize_objects(), per frame
+#   send       UnityBridge._send_data() to a socket pair, encoding included, per wire format
+#   loopback   a started bridge and a FrameClient: request/response round-trip time,
+#              and messages/s delivered in push mode while send() is called
+#              as fast as possible, per wire format
+#
+# python benchmark_unity_bridge.py --frames 2000
+
+import sys
+import os
+import argparse
+import selectors
+import socket
+import threading
+import time
+import zlib
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(script_dir)
+sys.path.append(script_dir + '/intel_hand_tracker')
+
+from mediapipe_utils import HandRegion
+from unity_bridge import UnityBridge, TestObject, FrameSnapshot, _ClientConnection, _DeltaState, _freeze
+from unity_bridge_client import FrameClient
+import unity_bridge_protocol as ubp
+
+# name: HELO options, None for a legacy client
+WIRE_FORMATS = {
+    "sentinel-json": None,
+    "header-json": {"framing": "header"},
+    "header-binary": {"framing": "header", "encoding": "binary"},
+    "header-delta": {"framing": "header", "delta": True},
+    "header-zlib": {"framing": "header", "compression": "zlib"},
+}
+HAND_CONFIG = ['label', 'xyz', 'rotated_world_landmarks']
+# Synthetic frames generated in advance, played in a loop
+_POOL_SIZE = 64
+
+
+def make_hand(rng, label):
+    hand = HandRegion()
+    hand.label = label
+    hand.lm_score = float(rng.uniform(0.8, 1))
+    hand.rotation = float(rng.uniform(-np.pi, np.pi))
+    hand.rotated_world_landmarks = rng.normal(0, 0.05, (21, 3)).astype(np.float32) + [0, 0, 0.5]
+    hand.xyz = hand.rotated_world_landmarks[0].copy()
+    return hand
+
+
+def make_frames(nb_hands, precision=None, seed=0):
+    """ _POOL_SIZE frames of (names, objects, configs): hands moving a little between frames. """
+    rng = np.random.default_rng(seed)
+    hands = [make_hand(rng, label) for label in ("left", "right")[:nb_hands]]
+    frames = []
+    for i in range(_POOL_SIZE):
+        test_object = TestObject(result="Success")
+        test_object.arr1 = [i]
+        objects = []
+        for hand in hands:
+            moved = HandRegion()
+            moved.__dict__.update(hand.__dict__)
+            moved.rotated_world_landmarks = hand.rotated_world_landmarks + rng.normal(0, 0.002, (21, 3)).astype(np.float32)
+            moved.xyz = moved.rotated_world_landmarks[0].copy()
+            objects.append(moved)
+        names = [f"hand_{j}" for j in range(len(objects))] + ['res2']
+        hand_config = HAND_CONFIG
+        if precision:
+            hand_config = ['label'] + [f"{field}:{precision}" for field in HAND_CONFIG[1:]]
+        configs = [hand_config] * len(objects) + [['result', 'arr1']]
+        frames.append((names, objects + [test_object], configs))
+    return frames
+
+
+def percentiles(samples):
+    if not samples:
+        return "-"
+    p50, p95, p99 = np.percentile(np.array(samples) * 1e6, [50, 95, 99])
+    return f"p50 {p50:8.1f}  p95 {p95:8.1f}  p99 {p99:8.1f} us"
+
+
+def bench_serialize(bridge, frames, n):
+    start = time.perf_counter()
+    for i in range(n):
+        names, objects, configs = frames[i % len(frames)]
+        _freeze(bridge._serialize_objects(names, objects, configs, "BENCH"))
+    return (time.perf_counter() - start) / n
+
+
+def _drain(sock, counter):
+    while True:
+        data = sock.recv(1 << 20)
+        if not data:
+            return
+        counter[0] += len(data)
+
+
+def bench_send(frames, options, n):
+    """ Time of _send_data() per frame, encoding included, and bytes per frame. """
+    bridge = UnityBridge(('127.0.0.1', 0))
+    bridge.selector = selectors.DefaultSelector()
+    server, peer = socket.socketpair()
+    server.setblocking(False)
+    client = _ClientConnection(server, ('socketpair', 0))
+    client.streaming = True
+    options = options or {}
+    client.framing = options.get("framing", ubp.FRAMING_SENTINEL)
+    client.encoding = options.get("encoding", ubp.ENCODING_JSON)
+    if options.get("delta"):
+        client.delta = _DeltaState(bridge.delta_keyframe_interval, bridge.delta_quantum)
+    if options.get("compression"):
+        client.compressor = zlib.compressobj(bridge.compression_level)
+    bridge.selector.register(server, selectors.EVENT_READ, client)
+    received = [0]
+    reader = threading.Thread(target=_drain, args=(peer, received), daemon=True)
+    reader.start()
+    snapshots = [FrameSnapshot(0, 0, _freeze(bridge._serialize_objects(*frame, "BENCH")),
+                               precisions=bridge._precisions(*frame)) for frame in frames]
+    elapsed = 0.0
+    for seq in range(1, n + 1):
+        template = snapshots[seq % len(snapshots)]
+        # A new snapshot per frame, so its encoding is not cached from a previous one
+        snapshot = FrameSnapshot(seq, ubp.timestamp_us(), template.data, precisions=template.precisions)
+        start = time.perf_counter()
+        bridge._send_data(client, snapshot)
+        elapsed += time.perf_counter() - start
+        while client.outqueue:
+            bridge._flush(client)
+        if client.delta is not None:
+            client.delta.ack(seq)
+    server.shutdown(socket.SHUT_WR)
+    reader.join()
+    server.close()
+    peer.close()
+    return elapsed / n, received[0] / n
+
+
+def bench_loopback(bridge, frames, options, n, duration):
+    """ Request/response round-trip times, then messages/s and bytes per message in push mode. """
+    publish(bridge, frames[0])
+    client = FrameClient(bridge.address, options, timeout=10.0)
+    rtts = []
+    for i in range(n):
+        publish(bridge, frames[i % len(frames)])
+        start = time.perf_counter()
+        client.request()
+        rtts.append(time.perf_counter() - start)
+    client.close()
+
+    client = FrameClient(bridge.address, options, acknowledge=True, timeout=10.0)
+    client.subscribe()
+    # Let the subscription reach the bridge before publishing
+    client.request()
+    start_bytes = client.bytes_received
+    done = threading.Event()
+    published = [0]
+
+    def publisher():
+        while not done.is_set():
+            publish(bridge, frames[published[0] % len(frames)])
+            published[0] += 1
+
+    received = 0
+    threading.Thread(target=publisher, daemon=True).start()
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        client.receive()
+        received += 1
+    elapsed = time.perf_counter() - start
+    done.set()
+    nb_bytes = client.bytes_received - start_bytes
+    client.close()
+    return rtts, received / elapsed, nb_bytes / max(received, 1), published[0] / elapsed
+
+
+def publish(bridge, frame):
+    names, objects, configs = frame
+    bridge.send(names, objects, configs, "BENCH")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--frames', type=int, default=2000, help="Frames per measurement (default=%(default)i)")
+    parser.add_argument('-d', '--duration', type=float, default=2.0,
+                        help="Duration of each push mode measure in seconds (default=%(default)s)")
+    parser.add_argument('-p', '--port', type=int, default=12399, help="Port of the loopback bridge (default=%(default)i)")
+    parser.add_argument('--formats', nargs='+', choices=list(WIRE_FORMATS), default=list(WIRE_FORMATS),
+                        help="Wire formats to measure")
+    parser.add_argument('--precision', help="Precision policy of the hand coordinates, e.g. mm, f16 or d3")
+    parser.add_argument('--no_loopback', action="store_true", help="Skip the measures through a started bridge")
+    args = parser.parse_args()
+
+    pools = {nb_hands: make_frames(nb_hands, args.precision) for nb_hands in (0, 1, 2)}
+
+    print("== serialize (_serialize_objects)")
+    bridge = UnityBridge(('127.0.0.1', 0))
+    for nb_hands, frames in pools.items():
+        print(f"{nb_hands} hands  {bench_serialize(bridge, frames, args.frames) * 1e6:8.1f} us/frame")
+
+    print("\n== send (_send_data, encoding included)")
+    for name in args.formats:
+        for nb_hands, frames in pools.items():
+            per_frame, per_message = bench_send(frames, WIRE_FORMATS[name], args.frames)
+            print(f"{name:14s} {nb_hands} hands  {per_frame * 1e6:8.1f} us/frame  {per_message:8.0f} bytes/frame")
+
+    if args.no_loopback:
+        return
+    print("\n== loopback (FrameClient)")
+    bridge = UnityBridge(('127.0.0.1', args.port), poll_interval=0)
+    bridge.start()
+    try:
+        for name in args.formats:
+            for nb_hands, frames in pools.items():
+                rtts, rate, per_message, published = bench_loopback(bridge, frames, WIRE_FORMATS[name],
+                                                                    args.frames, args.duration)
+                print(f"{name:14s} {nb_hands} hands  {rate:8.0f} msgs/s (of {published:.0f} sent/s)"
+                      f"  {per_message:8.0f} bytes/msg  RTT {percentiles(rtts)}")
+    finally:
+        bridge.close()
+
+
+if __name__ == '__main__':
+    main()
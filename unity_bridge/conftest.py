@@ -0,0 +1,2 @@
+# test_unity_bridge.py is a manual DepthAI example that starts a bridge on import, not a pytest module
+collect_ignore = ["test_unity_bridge.py"]
@@ -0,0 +1,9 @@
+@ECHO OFF
+if [%1]==[] goto :error
+python .\hand_tracking_hub.py -p %1 --internal_frame_width=640 --internal_frame_height=480
+goto :end
+
+:error
+echo Missing PORT parameter
+
+:end
\ No newline at end of file
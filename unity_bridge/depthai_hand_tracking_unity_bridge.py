@@ -16,12 +16,14 @@ sys.path.append(script_dir+'/depthai_hand_tracker')
 
 from HandTrackerRenderer import HandTrackerRenderer
 import argparse
+from unity_bridge import add_arguments, configure
 
 
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-p', '--port', type=int, help="Port")
+add_arguments(parser)
 parser.add_argument('-e', '--edge', action="store_true",
                     help="Use Edge mode (postprocessing runs on the device)")
 parser_tracker = parser.add_argument_group("Tracker arguments")
@@ -74,11 +76,15 @@ else:
 
 
 # -- UB
+# Fields of the hands sent to Unity, clients can ask for a part of them with HELO "fields"
+HAND_FIELDS = ['rotation','lm_score','label','xyz','get_rotated_world_landmarks']
 from unity_bridge import UnityBridge, TestObject
+from unity_bridge_protocol import READY_STREAMING
 # Unity Bridge Configuration
 # Example usage in the main application
 address = ('127.0.0.1', args.port)
 unity_bridge = UnityBridge(address)
+configure(unity_bridge, args)
 unity_bridge.start()
 test_object = TestObject(result="Success")
 # -- UB
@@ -99,6 +105,7 @@ tracker = HandTracker(
         lm_nb_threads=args.lm_nb_threads,
         **tracker_args
         )
+unity_bridge.set_ready(READY_STREAMING)
 
 #renderer = HandTrackerRenderer(
 #        tracker=tracker,
@@ -110,7 +117,8 @@ while True:
     # 'bag' contains some information related to the frame 
     # and not related to a particular hand like body keypoints in Body Pre Focusing mode
     # Currently 'bag' contains meaningful information only when Body Pre Focusing is used
-    frame, hands, bag, serialNumber = tracker.next_frame()
+    with unity_bridge.metrics.time("next_frame"):
+        frame, hands, bag, serialNumber = tracker.next_frame()
     if frame is None: break
     # Draw hands
 #    frame = renderer.draw(frame, hands, bag)
@@ -118,23 +126,11 @@ while True:
     # -- UB
     # Prepare data for serialization
     test_object.arr1 = [unity_bridge.count]
-    #print(len(hands))
-    if len(hands)==1:
-        names = ['hand_0','res2']
-        objects = [hands[0],test_object]
-        configs = [['rotation','lm_score','label','xyz','get_rotated_world_landmarks'],['result','arr1']]  # List of fields to serialize for each object
-    elif len(hands)==2:
-        names = ['hand_0','hand_1','res2']
-        objects = [hands[0],hands[1],test_object]
-        configs = [['rotation','lm_score','label','xyz','get_rotated_world_landmarks'],['rotation','lm_score','xyz','label','get_rotated_world_landmarks'],['result','arr1']]  # List of fields to serialize for each object
-    else:
-        names = ['res2']
-        objects = [test_object]
-        configs = [['result','arr1']]  # List of fields to serialize for each object
-
-    # Send data back to Unity
+
+    # Send data back to Unity: hand_0, hand_1 with the subscribed HAND_FIELDS, and res2
     #frame_ub = cv2.resize(frame,(576,324))
-    unity_bridge.send(names, objects, configs, serialNumber)
+    unity_bridge.send_hands(hands[:2], HAND_FIELDS, serialNumber, frame,
+                            ['res2'], [test_object], [['result','arr1']])
     # -- UB
 
 #    key = renderer.waitKey(delay=1)
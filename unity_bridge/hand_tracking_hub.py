@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# Hub mode: one process tracks the hands on every connected RealSense camera,
+# each camera on its own worker thread, and publishes all of them through a
+# single UnityBridge. Frames carry the serialNumber of their camera; clients
+# choose their cameras with HELO {"cameras": ["<serial number>", ...]}.
+# With --processes each camera is tracked in its own worker process instead
+# (see TrackerPool), so the inferences of the cameras run on several cores.
+
+# Adjust python path for UnityBridge
+import sys
+import os
+import threading
+
+# -- UB
+script_dir = os.path.dirname(os.path.abspath(__file__))  # Directory of the script
+sys.path.append(script_dir)
+sys.path.append(script_dir+'/intel_hand_tracker')
+# -- UB
+
+import argparse
+from unity_bridge import add_arguments, configure
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-p', '--port', type=int, required=True, help="Port")
+parser.add_argument('--max_cameras', type=int,
+                    help="Open at most MAX_CAMERAS cameras (default: all the connected ones)")
+parser.add_argument('--processes', action="store_true",
+                    help="Track each camera in its own worker process instead of a thread")
+add_arguments(parser, images=False)
+parser_tracker = parser.add_argument_group("Tracker arguments")
+parser_tracker.add_argument('--internal_frame_height', type=int,
+                    help="Internal color camera frame height in pixels")
+parser_tracker.add_argument('--internal_frame_width', type=int,
+                    help="Internal color camera frame width in pixels")
+parser_tracker.add_argument('--inference_width', type=int,
+                    help="Width of the image given to MediaPipe, downscaled from the color frame (default: full frame)")
+parser_tracker.add_argument('--inference_height', type=int,
+                    help="Height of the image given to MediaPipe (default: keeps the aspect ratio of the color frame)")
+parser_tracker.add_argument('--pipelined', action="store_true",
+                    help="Capture, inference and post-processing on their own threads, overlapping the camera wait and the inference")
+parser_tracker.add_argument('--queue_size', type=int, default=1,
+                    help="Pipelined mode: frames queued between two stages (default=%(default)i)")
+parser_tracker.add_argument('--drop_policy', choices=['oldest', 'newest', 'block'], default='oldest',
+                    help="Pipelined mode: frame dropped when a stage falls behind, or 'block' to drop none (default=%(default)s)")
+args = parser.parse_args()
+dargs = vars(args)
+tracker_args = {a:dargs[a] for a in ['internal_frame_height', 'internal_frame_width', 'inference_width', 'inference_height',
+                                        'pipelined', 'queue_size', 'drop_policy'] if dargs[a] is not None}
+
+import pyrealsense2 as rs
+from IntelHandTracker import IntelHandTracker, base_id
+from TrackerPool import TrackerPool
+
+from unity_bridge import UnityBridge, TestObject
+from unity_bridge_protocol import READY_STREAMING
+
+# Fields of the hands sent to Unity, clients can ask for a part of them with HELO "fields"
+HAND_FIELDS = ['label', 'xyz', 'rotated_world_landmarks']
+
+
+class CameraWorker(threading.Thread):
+    """ Runs one tracker and sends its results to the shared bridge. """
+    def __init__(self, tracker, unity_bridge):
+        super().__init__(daemon=True)
+        self.tracker = tracker
+        self.unity_bridge = unity_bridge
+        self.running = True
+        self.test_object = TestObject(result="Success")
+
+    def run(self):
+        count = 0
+        try:
+            while self.running:
+                result = self.tracker.next_frame()
+                if result is None:
+                    if self.tracker.stage_error is not None:
+                        break
+                    continue
+                frame, hands, serialNumber = result
+                self.test_object.arr1 = [count]
+                count = count + 1
+                self.unity_bridge.send_hands(hands[:2], HAND_FIELDS, serialNumber, frame,
+                                             ['res2'], [self.test_object], [['result', 'arr1']],
+                                             self.tracker.capture_time)
+        finally:
+            # Also on an error of this camera, the other workers go on
+            self.tracker.exit()
+
+
+def run_threads(unity_bridge, nb_devices):
+    """ One tracker per camera, each on a CameraWorker thread of this process. """
+    workers = []
+    for index in range(nb_devices):
+        # IntelHandTracker picks the device at index device_id - base_id
+        tracker = IntelHandTracker(base_id + index, metrics=unity_bridge.metrics,
+                                   on_streaming=lambda: unity_bridge.set_ready(READY_STREAMING), **tracker_args)
+        if tracker.created:
+            workers.append(CameraWorker(tracker, unity_bridge))
+    if not workers:
+        print("No camera could be opened. Exiting.")
+        return
+
+    print(f"Hub serving {len(workers)} camera(s) on port {args.port}: "
+          + ", ".join(worker.tracker.serial_number for worker in workers))
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.running = False
+        for worker in workers:
+            worker.join()
+
+
+def run_processes(unity_bridge, nb_devices):
+    """ One tracker per camera, each in a worker process, see TrackerPool. """
+    pool = TrackerPool([base_id + index for index in range(nb_devices)], 2, tracker_args)
+    if not pool.serials:
+        print("No camera could be opened. Exiting.")
+        pool.close()
+        return
+    unity_bridge.set_ready(READY_STREAMING)
+    print(f"Hub serving {len(pool.serials)} camera(s) on port {args.port}, one process each: "
+          + ", ".join(pool.serials.values()))
+    test_object = TestObject(result="Success")
+    count = 0
+    try:
+        while pool.serials:
+            for serialNumber, hands, points, capture_time in pool.next_results(timeout=1.0):
+                test_object.arr1 = [count]
+                count = count + 1
+                unity_bridge.send_hands(hands, HAND_FIELDS, serialNumber, None,
+                                        ['res2'], [test_object], [['result', 'arr1']], capture_time)
+        print("Every tracker worker exited. Exiting.")
+    except KeyboardInterrupt:
+        pass
+    pool.close()
+
+
+def main():
+    # -- UB
+    address = ('127.0.0.1', args.port)
+    unity_bridge = UnityBridge(address)
+    configure(unity_bridge, args)
+    unity_bridge.start()
+    # -- UB
+
+    nb_devices = len(rs.context().query_devices())
+    if args.max_cameras is not None:
+        nb_devices = min(nb_devices, args.max_cameras)
+    if args.processes:
+        run_processes(unity_bridge, nb_devices)
+    else:
+        run_threads(unity_bridge, nb_devices)
+    unity_bridge.close()
+
+
+# The worker processes of --processes import this script again, without running main()
+if __name__ == '__main__':
+    main()
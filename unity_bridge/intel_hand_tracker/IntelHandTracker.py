@@ -1,5 +1,7 @@
-import array
-from time import sleep
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
 import pyrealsense2 as rs
 import numpy as np
 import cv2
@@ -8,16 +10,128 @@ import mediapipe_utils as mpu
 
 base_id = 12357
 
+# Pipelined mode: what a full queue between two stages does with a new item
+DROP_OLDEST = 'oldest'  # drop the oldest queued item, the freshest frames go through
+DROP_NEWEST = 'newest'  # drop the new item, the queued ones are processed first
+DROP_NONE = 'block'  # no drop, the producer waits for room
+DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST, DROP_NONE)
+
+
+class StageQueue:
+    """ Bounded queue between two threads of the pipelined mode, dropping items as its policy says. """
+    def __init__(self, size=1, drop_policy=DROP_OLDEST):
+        if size < 1:
+            raise ValueError("The queue size must be at least 1")
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy: {drop_policy}")
+        self.size = size
+        self.drop_policy = drop_policy
+        self.items_dropped = 0
+        self._items = deque()
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def put(self, item):
+        with self._cond:
+            if self.drop_policy == DROP_NONE:
+                self._cond.wait_for(lambda: len(self._items) < self.size or self._closed)
+            elif len(self._items) >= self.size:
+                self.items_dropped += 1
+                if self.drop_policy == DROP_NEWEST:
+                    return
+                self._items.popleft()
+            if self._closed:
+                return
+            self._items.append(item)
+            self._cond.notify_all()
+
+    def get(self):
+        """ The next item, None once the queue is closed. """
+        with self._cond:
+            self._cond.wait_for(lambda: self._items or self._closed)
+            if self._closed:
+                return None
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class DepthIntrinsics:
+    """ Intrinsics and depth units of a depth stream profile, read once per profile.
+
+    deproject() is rs2_deproject_pixel_to_point() applied to whole arrays.
+    """
+    def __init__(self, depth_frame):
+        intrinsics = depth_frame.profile.as_video_stream_profile().intrinsics
+        self.principal_point = np.array([intrinsics.ppx, intrinsics.ppy])
+        self.focal_length = np.array([intrinsics.fx, intrinsics.fy])
+        self.model = intrinsics.model
+        self.coeffs = [float(coeff) for coeff in intrinsics.coeffs]
+        # Meters per depth unit, as used by depth_frame.get_distance()
+        self.depth_units = depth_frame.get_units()
+
+    def deproject(self, pixels, depth):
+        """ 3D points, float32 (..., 3), of the pixels (..., 2) at the depths (...) in meters. """
+        xy = (np.asarray(pixels, dtype=np.float64) - self.principal_point) / self.focal_length
+        x, y = xy[..., 0], xy[..., 1]
+        c = self.coeffs
+        if self.model in (rs.distortion.brown_conrady, rs.distortion.inverse_brown_conrady) and any(c):
+            # Iterative undistortion, 10 iterations as librealsense
+            xo, yo = x, y
+            for _ in range(10):
+                r2 = x * x + y * y
+                icdist = 1 / (1 + ((c[4] * r2 + c[1]) * r2 + c[0]) * r2)
+                xq, yq = (x / icdist, y / icdist) if self.model == rs.distortion.inverse_brown_conrady else (x, y)
+                delta_x = 2 * c[2] * xq * yq + c[3] * (r2 + 2 * xq * xq)
+                delta_y = 2 * c[3] * xq * yq + c[2] * (r2 + 2 * yq * yq)
+                x = (xo - delta_x) * icdist
+                y = (yo - delta_y) * icdist
+        elif self.model == rs.distortion.kannala_brandt4:
+            rd = np.maximum(np.sqrt(x * x + y * y), np.finfo(np.float32).eps)
+            # Newton iterations on the angle from the optical axis
+            theta = rd
+            for _ in range(4):
+                theta2 = theta * theta
+                f = theta * (1 + theta2 * (c[0] + theta2 * (c[1] + theta2 * (c[2] + theta2 * c[3])))) - rd
+                df = 1 + theta2 * (3 * c[0] + theta2 * (5 * c[1] + theta2 * (7 * c[2] + 9 * theta2 * c[3])))
+                theta = theta - f / df
+            x = x * np.tan(theta) / rd
+            y = y * np.tan(theta) / rd
+        elif self.model == rs.distortion.ftheta:
+            rd = np.maximum(np.sqrt(x * x + y * y), np.finfo(np.float32).eps)
+            r = np.tan(c[0] * rd) / np.arctan(2 * np.tan(c[0] / 2))
+            x = x * r / rd
+            y = y * r / rd
+        points = np.empty(np.shape(depth) + (3,), dtype=np.float32)
+        points[..., 0] = depth * x
+        points[..., 1] = depth * y
+        points[..., 2] = depth
+        return points
+
 
 class IntelHandTracker:
     def __init__(
-        self, device_id=base_id, internal_frame_height=480, internal_frame_width=640
+        self, device_id=base_id, internal_frame_height=480, internal_frame_width=640, metrics=None,
+        on_streaming=None, pipelined=False, queue_size=1, drop_policy=DROP_OLDEST, inference_width=None,
+        inference_height=None
     ):
         self.serial_number = None
+        # Pipelined mode: capture, inference and post-processing threads, see start_pipeline()
+        self._threads = []
+        # Pipelined mode: the error that stopped a stage thread, next_frame() then returns None
+        self.stage_error = None
+        # time.time() the frames returned by the last next_frame() were taken
+        self.capture_time = None
+        # Optional unity_bridge_metrics.Metrics timing the stages of next_frame()
+        self.metrics = metrics
         context = rs.context()
         devices = context.query_devices()
         if len(devices) == 0:
-            sleep(1)
             print("\nNo devices connected. Exiting.")
             self.created = False
             return None
@@ -40,6 +154,22 @@ class IntelHandTracker:
 
         self.internal_frame_width = internal_frame_width
         self.internal_frame_height = internal_frame_height
+        # DepthIntrinsics by stream profile unique_id(), see deproject_pixels()
+        self.intrinsics = {}
+        # Landmarks of the hands returned by the last next_frame(), float32 (hands, 21, 3) in meters
+        self.hand_points = np.zeros((0, 21, 3), dtype=np.float32)
+        # (width, height) of the image given to MediaPipe, None for the full frame. The
+        # depth is still read at full resolution: the landmarks are normalized, so they
+        # map back to the full frame pixels whatever the inference resolution.
+        self.inference_size = None
+        if inference_width or inference_height:
+            self.inference_size = (
+                inference_width or round(internal_frame_width * inference_height / internal_frame_height),
+                inference_height or round(internal_frame_height * inference_width / internal_frame_width),
+            )
+        # Buffers reused by every frame for the downscaled and the RGB images, see _inference_image()
+        self._resized_image = None
+        self._rgb_image = None
 
         # Configure the pipeline to stream color and depth frames
         config.enable_stream(
@@ -67,89 +197,219 @@ class IntelHandTracker:
         self.handsTracker = mp.solutions.hands.Hands(
             static_image_mode=False, max_num_hands=2, min_detection_confidence=0.5
         )
-        sleep(2)
+        # The camera is streaming once a first pair of frames arrives
+        try:
+            self.pipeline.wait_for_frames()
+        except RuntimeError as e:
+            print("\nNo frames from the device with serial number " + self.serial_number + ": " + str(e))
+            self.pipeline.stop()
+            self.created = False
+            return None
         print("\nConnected to a device with serial number " + self.serial_number + ".")
         self.created = True
+        if on_streaming is not None:
+            on_streaming()
+        if pipelined:
+            self.start_pipeline(queue_size, drop_policy)
+
+    def start_pipeline(self, queue_size=1, drop_policy=DROP_OLDEST):
+        """ Run the capture, the inference and the post-processing on their own threads.
+
+        The camera wait and the inference then overlap: frames are tracked at the
+        pace of the slowest stage instead of the sum of all of them. The stages are
+        linked by StageQueues of queue_size items, dropping frames as drop_policy
+        says when a stage falls behind. next_frame() returns the freshest result.
+        """
+        self.captured = StageQueue(queue_size, drop_policy)
+        self.inferred = StageQueue(queue_size, drop_policy)
+        self._result = None
+        self._result_seq = 0
+        self._returned_seq = 0
+        self._result_cond = threading.Condition()
+        self._running = True
+        self._threads = [threading.Thread(target=self._run_stage, args=(loop,), daemon=True)
+                         for loop in (self._capture_loop, self._inference_loop, self._post_process_loop)]
+        for thread in self._threads:
+            thread.start()
+
+    def stage(self, name):
+        return self.metrics.time(name) if self.metrics is not None else nullcontext()
 
     def next_frame(self):
+        """ (color image, hands, serial number) of the next frame, None for an incomplete frameset.
+
+        In pipelined mode: the freshest result not returned yet, None once exit() is called
+        or a stage failed (stage_error).
+        """
+        if self._threads:
+            with self._result_cond:
+                self._result_cond.wait_for(lambda: self._result_seq > self._returned_seq or not self._running)
+                if not self._running:
+                    return None
+                self._returned_seq = self._result_seq
+                result = self._result
+            return self._deliver(result)
+        inferred = self._infer(self._capture())
+        if inferred is None:
+            return
+        return self._deliver(self._post_process(inferred))
+        # return color_image, self.hands, self.device.getMxId()
+
+    def _capture(self):
+        """ (frameset, capture time) of the next pair of frames of the camera. """
         # Wait for a coherent pair of frames: depth and color
-        frames = self.pipeline.wait_for_frames()
+        with self.stage("wait_for_frames"):
+            frames = self.pipeline.wait_for_frames()
+        if frames.get_frame_timestamp_domain() in (rs.timestamp_domain.global_time, rs.timestamp_domain.system_time):
+            # Milliseconds since the epoch, on the host clock
+            capture_time = frames.get_timestamp() / 1000
+        else:
+            # Device clock only: the arrival time is the closest host time
+            capture_time = time.time()
+        return frames, capture_time
+
+    def _infer(self, captured):
+        """ (color image, MediaPipe results, depth frame, color frame, capture time), None for an incomplete frameset. """
+        frames, capture_time = captured
         depth_frame = frames.get_depth_frame()
         color_frame = frames.get_color_frame()
 
         if not depth_frame or not color_frame:
-            return
+            return None
 
         # Convert images to numpy arrays
         color_image = np.asanyarray(color_frame.get_data())
 
-        # Convert the BGR image to RGB for MediaPipe
-        rgb_image = cv2.cvtColor(color_image, cv2.COLOR_BGR2RGB)
+        rgb_image = self._inference_image(color_image)
 
         # Process the image and find hands
-        results = self.handsTracker.process(rgb_image)
+        with self.stage("process"):
+            results = self.handsTracker.process(rgb_image)
+        return color_image, results, depth_frame, color_frame, capture_time
 
-        i = 0
-        hands = []
-        if results.multi_hand_landmarks:
-            hands = [dict] * len(results.multi_hand_landmarks)
-            for hand_landmarks in results.multi_hand_landmarks:
-                hands[i] = mpu.HandRegion()
-                j = 0
-                landmark_array = [array] * 21
-                for landmark_data in hand_landmarks.landmark:
-                    # Calculate 3D coordinates for each landmark
-                    landmark = landmark_data
-                    # Convert normalized coordinates to image coordinates
-                    pixel_x = int(landmark.x * color_frame.get_width())
-                    pixel_y = int(landmark.y * color_frame.get_height())
-
-                    # Get the depth value at the landmark's position
-                    if (
-                        pixel_x < 0
-                        or pixel_x >= self.internal_frame_width
-                        or pixel_y < 0
-                        or pixel_y >= self.internal_frame_height
-                    ):
-                        hands = []
-                        i = -1
-                        break
-                    # print (pixel_y)
-                    depth = depth_frame.get_distance(pixel_x, pixel_y)
-
-                    # Get depth frame intrinsics
-                    depth_intrinsics = (
-                        depth_frame.profile.as_video_stream_profile().intrinsics
-                    )
-
-                    # Convert from pixel coordinates to 3D coordinates
-                    position = rs.rs2_deproject_pixel_to_point(
-                        depth_intrinsics, [pixel_x, pixel_y], depth
-                    )
-                    if j == 0:
-                        hands[i].xyz = position
-
-                    landmark_array[j] = [float] * 3
-                    landmark_array[j][0] = position[0]
-                    landmark_array[j][1] = position[1]
-                    landmark_array[j][2] = position[2]
-                    j = j + 1
-                if i >= 0:
-                    hands[i].rotated_world_landmarks = landmark_array
-                    hands[i].label = (
-                        "left"
-                        if results.multi_handedness[i].classification[0].label
-                        == "Right"
-                        else "right"
-                    )
-                    print(hands[i].label)
-                    i = i + 1
-                else:
-                    break
+    def _inference_image(self, color_image):
+        """ The RGB image given to MediaPipe, at the inference resolution, in buffers reused by every frame. """
+        height, width = color_image.shape[:2]
+        inference_width, inference_height = self.inference_size or (width, height)
+        if self._rgb_image is None or self._rgb_image.shape[:2] != (inference_height, inference_width):
+            self._rgb_image = np.empty((inference_height, inference_width, 3), dtype=np.uint8)
+            self._resized_image = np.empty_like(self._rgb_image) if (inference_width, inference_height) != (width, height) else None
+        if self._resized_image is not None:
+            # Downscaled first, so the color conversion has fewer pixels to convert
+            with self.stage("resize"):
+                cv2.resize(color_image, (inference_width, inference_height), dst=self._resized_image,
+                           interpolation=cv2.INTER_AREA)
+            color_image = self._resized_image
+        # Convert the BGR image to RGB for MediaPipe
+        with self.stage("cvtColor"):
+            cv2.cvtColor(color_image, cv2.COLOR_BGR2RGB, dst=self._rgb_image)
+        return self._rgb_image
+
+    def _post_process(self, inferred):
+        """ (color image, hands, hand points, capture time) """
+        color_image, results, depth_frame, color_frame, capture_time = inferred
+        with self.stage("deprojection"):
+            hands, points = self._deproject(results, depth_frame, color_frame)
+        return color_image, hands, points, capture_time
+
+    def _deliver(self, result):
+        color_image, hands, self.hand_points, self.capture_time = result
         return color_image, hands, self.serial_number
-        # return color_image, self.hands, self.device.getMxId()
+
+    def _run_stage(self, loop):
+        """ Stage thread: an error stops the whole pipeline, so next_frame() does not wait forever. """
+        try:
+            loop()
+        except Exception as e:
+            print("\nTracking stopped for the device with serial number " + self.serial_number + ": " + repr(e))
+            self.stage_error = e
+            self._stop_stages()
+
+    def _stop_stages(self):
+        self._running = False
+        self.captured.close()
+        self.inferred.close()
+        with self._result_cond:
+            self._result_cond.notify_all()
+
+    def _capture_loop(self):
+        while self._running:
+            try:
+                captured = self._capture()
+            except RuntimeError as e:
+                print("\nNo frames from the device with serial number " + self.serial_number + ": " + str(e))
+                continue
+            self.captured.put(captured)
+
+    def _inference_loop(self):
+        while True:
+            captured = self.captured.get()
+            if captured is None:
+                return
+            inferred = self._infer(captured)
+            if inferred is not None:
+                self.inferred.put(inferred)
+
+    def _post_process_loop(self):
+        while True:
+            inferred = self.inferred.get()
+            if inferred is None:
+                return
+            result = self._post_process(inferred)
+            with self._result_cond:
+                self._result = result
+                self._result_seq += 1
+                self._result_cond.notify_all()
+
+    def _deproject(self, results, depth_frame, color_frame):
+        """ (hands, float32 (hands, 21, 3) landmarks) of the MediaPipe results. """
+        hands = []
+        no_points = np.zeros((0, 21, 3), dtype=np.float32)
+        if not results.multi_hand_landmarks:
+            return hands, no_points
+        # Pixel of every landmark of every hand in the full resolution frame, (hands, 21, 2),
+        # truncated as int() does. The landmarks are normalized to the image MediaPipe
+        # processed, which covers the whole frame at any inference resolution.
+        normalized = np.array([[(landmark.x, landmark.y) for landmark in hand_landmarks.landmark]
+                               for hand_landmarks in results.multi_hand_landmarks])
+        pixels = np.trunc(normalized * (color_frame.get_width(), color_frame.get_height())).astype(np.int32)
+        if ((pixels < 0) | (pixels >= (self.internal_frame_width, self.internal_frame_height))).any():
+            # A landmark out of the frame has no depth, no hand is sent for this frame
+            return hands, no_points
+        points = self.deproject_pixels(pixels, depth_frame)
+        # The landmarks of each hand are views of the (hands, 21, 3) array
+        for i, hand_points in enumerate(points):
+            hand = mpu.HandRegion()
+            hand.xyz = hand_points[0]
+            hand.rotated_world_landmarks = hand_points
+            hand.label = (
+                "left"
+                if results.multi_handedness[i].classification[0].label
+                == "Right"
+                else "right"
+            )
+            print(hand.label)
+            hands.append(hand)
+        return hands, points
+
+    def deproject_pixels(self, pixels, depth_frame):
+        """ 3D points in meters, float32 (..., 3), of the depth frame pixels (..., 2) given as (x, y). """
+        profile = depth_frame.profile
+        intrinsics = self.intrinsics.get(profile.unique_id())
+        if intrinsics is None:
+            intrinsics = self.intrinsics[profile.unique_id()] = DepthIntrinsics(depth_frame)
+        # The depth frame buffer seen as an array, not copied
+        depth_image = np.asanyarray(depth_frame.get_data())
+        depth = depth_image[pixels[..., 1], pixels[..., 0]] * intrinsics.depth_units
+        return intrinsics.deproject(pixels, depth)
 
     def exit(self):
+        if self._threads:
+            # Stop the stages, the capture thread returns with its next frames
+            self._stop_stages()
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
         # Stop the pipeline
         self.pipeline.stop()
         cv2.destroyAllWindows()
\ No newline at end of file
@@ -0,0 +1,208 @@
+import multiprocessing
+import queue
+import struct
+from multiprocessing import shared_memory
+import numpy as np
+import mediapipe_utils as mpu
+
+# Process-pool runner: one IntelHandTracker per worker process, so the
+# MediaPipe inference of several cameras runs on several cores instead of
+# taking turns on the GIL of a single interpreter.
+#
+# Each worker writes the result of its last frame to its own shared memory
+# block, then puts its index on the notification queue: the hand arrays are
+# never pickled. The parent copies the blocks of the workers that notified.
+#
+# result block
+#   lock          Q    seqlock counter, odd while the block is being written
+#   seq           Q    frames tracked by the worker so far
+#   capture_time  d    time.time() the frames were taken
+#   hands         I    number of valid hands
+#   pad           4x
+#   labels        max_hands B, LABELS codes, padded to a multiple of 8 bytes
+#   points        max_hands * 21 * 3 float32, landmarks in meters
+#
+# A reader copies the block and checks that its lock did not change meanwhile
+# and is even, otherwise it retries.
+
+RESULT_HEADER = struct.Struct('<QQdI4x')
+NB_LANDMARKS = 21
+LABELS = {None: 0, "left": 1, "right": 2}
+LABEL_NAMES = {code: label for label, code in LABELS.items()}
+_LOCK = struct.Struct('<Q')
+# How many times the parent retries a block being written before waiting for the next frame
+_READ_RETRIES = 100
+
+
+class ResultBlock:
+    """ Arrays over the shared memory block of one worker, see the layout above. """
+    def __init__(self, buf, max_hands):
+        self.buf = buf
+        self.max_hands = max_hands
+        self.labels = np.ndarray((max_hands,), dtype=np.uint8, buffer=buf, offset=RESULT_HEADER.size)
+        self.points = np.ndarray((max_hands, NB_LANDMARKS, 3), dtype='<f4', buffer=buf,
+                                 offset=RESULT_HEADER.size + self.labels_size(max_hands))
+
+    @staticmethod
+    def labels_size(max_hands):
+        return (max_hands + 7) // 8 * 8
+
+    @staticmethod
+    def size(max_hands):
+        return RESULT_HEADER.size + ResultBlock.labels_size(max_hands) + max_hands * NB_LANDMARKS * 3 * 4
+
+    def write(self, seq, hands, points, capture_time):
+        nb_hands = min(len(hands), self.max_hands)
+        lock, = _LOCK.unpack_from(self.buf, 0)
+        _LOCK.pack_into(self.buf, 0, lock + 1)
+        for i in range(nb_hands):
+            self.labels[i] = LABELS.get(getattr(hands[i], 'label', None), 0)
+        self.points[:nb_hands] = points[:nb_hands]
+        RESULT_HEADER.pack_into(self.buf, 0, lock + 1, seq, capture_time or 0.0, nb_hands)
+        _LOCK.pack_into(self.buf, 0, lock + 2)
+
+    def read(self):
+        """ (seq, capture time, labels, float32 (hands, 21, 3) points), None while being written. """
+        for _ in range(_READ_RETRIES):
+            lock, seq, capture_time, nb_hands = RESULT_HEADER.unpack_from(self.buf, 0)
+            if lock & 1:
+                continue
+            labels = self.labels[:nb_hands].copy()
+            points = self.points[:nb_hands].copy()
+            if _LOCK.unpack_from(self.buf, 0)[0] == lock:
+                return seq, capture_time or None, labels, points
+        return None
+
+    def release(self):
+        # The arrays must be gone before the shared memory is closed
+        self.labels = self.points = None
+
+
+def _work(index, device_id, block_name, max_hands, tracker_args, notifications, stop):
+    """ Worker process: track the hands of one camera and publish them to its block. """
+    from IntelHandTracker import IntelHandTracker
+    block = shared_memory.SharedMemory(name=block_name)
+    results = ResultBlock(block.buf, max_hands)
+    tracker = None
+    try:
+        tracker = IntelHandTracker(device_id, **tracker_args)
+        if not tracker.created:
+            tracker = None
+            notifications.put(("failed", index, None))
+            return
+        notifications.put(("ready", index, tracker.serial_number))
+        seq = 0
+        while not stop.is_set():
+            result = tracker.next_frame()
+            if result is None:
+                if tracker.stage_error is not None:
+                    # The pipeline stopped, the parent notices the worker exited
+                    break
+                continue
+            frame, hands, serial_number = result
+            seq += 1
+            results.write(seq, hands, tracker.hand_points, tracker.capture_time)
+            notifications.put(("frame", index, seq))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if tracker is not None:
+            tracker.exit()
+        results.release()
+        block.close()
+
+
+class TrackerPool:
+    """ Runs one IntelHandTracker per worker process and collects their hands in the parent.
+
+    device_ids: device ids given to IntelHandTracker, one worker each
+    max_hands: hands kept per frame
+    tracker_args: other IntelHandTracker arguments (internal_frame_width, pipelined...)
+    Workers whose camera could not be opened, or that exited since (unplugged
+    camera, crash), are left out of `serials`.
+    """
+    def __init__(self, device_ids, max_hands=2, tracker_args=None, start_timeout=60):
+        context = multiprocessing.get_context('spawn')
+        self.max_hands = max_hands
+        self.notifications = context.Queue()
+        self._stop = context.Event()
+        self.blocks = [shared_memory.SharedMemory(create=True, size=ResultBlock.size(max_hands)) for _ in device_ids]
+        self.results = [ResultBlock(block.buf, max_hands) for block in self.blocks]
+        self.processes = [context.Process(target=_work, daemon=True,
+                                          args=(index, device_id, block.name, max_hands, tracker_args or {},
+                                                self.notifications, self._stop))
+                          for index, (device_id, block) in enumerate(zip(device_ids, self.blocks))]
+        for process in self.processes:
+            process.start()
+        # Serial number of the camera of each worker that started, by worker index
+        self.serials = {}
+        self._last_seqs = {}
+        started = 0
+        while started < len(self.processes):
+            try:
+                kind, index, value = self.notifications.get(timeout=start_timeout)
+            except queue.Empty:
+                print("Tracker workers did not start in time")
+                break
+            if kind == "frame":
+                continue
+            started += 1
+            if kind == "ready":
+                self.serials[index] = value
+                self._last_seqs[index] = 0
+
+    def next_results(self, timeout=None):
+        """ [(serial number, hands, float32 (hands, 21, 3) points, capture time)] of the workers with new frames.
+
+        Waits for a first notification, then takes every one already queued, so
+        each worker gives at most its last frame. [] on timeout.
+        """
+        self._remove_exited()
+        try:
+            notified = [self.notifications.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                notified.append(self.notifications.get_nowait())
+            except queue.Empty:
+                break
+        results = []
+        for index in sorted({index for kind, index, value in notified if kind == "frame"}):
+            if index not in self.serials:
+                continue
+            result = self.results[index].read()
+            if result is None or result[0] <= self._last_seqs[index]:
+                continue
+            seq, capture_time, labels, points = result
+            self._last_seqs[index] = seq
+            hands = []
+            # The landmarks of each hand are views of the (hands, 21, 3) array, as in IntelHandTracker
+            for label, hand_points in zip(labels, points):
+                hand = mpu.HandRegion()
+                hand.label = LABEL_NAMES.get(int(label))
+                hand.xyz = hand_points[0]
+                hand.rotated_world_landmarks = hand_points
+                hands.append(hand)
+            results.append((self.serials[index], hands, points, capture_time))
+        return results
+
+    def _remove_exited(self):
+        """ Leave out of `serials` the workers that exited while tracking. """
+        for index in list(self.serials):
+            process = self.processes[index]
+            if not process.is_alive():
+                print(f"Tracker worker of camera {self.serials[index]} exited (code {process.exitcode})")
+                del self.serials[index]
+
+    def close(self, timeout=5):
+        self._stop.set()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        for results in self.results:
+            results.release()
+        for block in self.blocks:
+            block.close()
+            block.unlink()
@@ -0,0 +1,18 @@
+import sys
+import types
+
+# The tracker modules import pyrealsense2 and mediapipe, the tests use neither a
+# camera nor MediaPipe: stand-ins with the constants they use when not installed
+try:
+    import pyrealsense2
+except ImportError:
+    rs = types.ModuleType('pyrealsense2')
+    rs.distortion = types.SimpleNamespace(none=0, modified_brown_conrady=1, inverse_brown_conrady=2, ftheta=3,
+                                          brown_conrady=4, kannala_brandt4=5)
+    rs.timestamp_domain = types.SimpleNamespace(hardware_clock=0, system_time=1, global_time=2)
+    rs.error = RuntimeError
+    sys.modules['pyrealsense2'] = rs
+try:
+    import mediapipe
+except ImportError:
+    sys.modules['mediapipe'] = types.ModuleType('mediapipe')
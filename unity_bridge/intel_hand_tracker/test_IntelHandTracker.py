@@ -0,0 +1,157 @@
+import math
+import threading
+import time
+import types
+import numpy as np
+import pytest
+import pyrealsense2 as rs
+import IntelHandTracker
+from IntelHandTracker import DepthIntrinsics, StageQueue, DROP_NEWEST, DROP_NONE, DROP_OLDEST
+
+PPX, PPY, FX, FY = 320.5, 240.2, 385.0, 384.0
+FLT_EPSILON = 1.1920929e-07
+
+
+def rs2_deproject_pixel_to_point(model, coeffs, pixel, depth):
+    """ Scalar port of rs2_deproject_pixel_to_point() from librealsense (rsutil.h). """
+    c = coeffs
+    x = (pixel[0] - PPX) / FX
+    y = (pixel[1] - PPY) / FY
+    xo, yo = x, y
+    if model in (rs.distortion.brown_conrady, rs.distortion.inverse_brown_conrady):
+        for _ in range(10):
+            r2 = x * x + y * y
+            icdist = 1 / (1 + ((c[4] * r2 + c[1]) * r2 + c[0]) * r2)
+            xq, yq = (x / icdist, y / icdist) if model == rs.distortion.inverse_brown_conrady else (x, y)
+            delta_x = 2 * c[2] * xq * yq + c[3] * (r2 + 2 * xq * xq)
+            delta_y = 2 * c[3] * xq * yq + c[2] * (r2 + 2 * yq * yq)
+            x = (xo - delta_x) * icdist
+            y = (yo - delta_y) * icdist
+    if model == rs.distortion.kannala_brandt4:
+        rd = max(math.sqrt(x * x + y * y), FLT_EPSILON)
+        theta = rd
+        theta2 = rd * rd
+        for _ in range(4):
+            f = theta * (1 + theta2 * (c[0] + theta2 * (c[1] + theta2 * (c[2] + theta2 * c[3])))) - rd
+            if abs(f) < FLT_EPSILON:
+                break
+            df = 1 + theta2 * (3 * c[0] + theta2 * (5 * c[1] + theta2 * (7 * c[2] + 9 * theta2 * c[3])))
+            theta -= f / df
+            theta2 = theta * theta
+        r = math.tan(theta)
+        x *= r / rd
+        y *= r / rd
+    if model == rs.distortion.ftheta:
+        rd = max(math.sqrt(x * x + y * y), FLT_EPSILON)
+        r = math.tan(c[0] * rd) / math.atan(2 * math.tan(c[0] / 2))
+        x *= r / rd
+        y *= r / rd
+    return [depth * x, depth * y, depth]
+
+
+def depth_frame(model, coeffs):
+    intrinsics = types.SimpleNamespace(ppx=PPX, ppy=PPY, fx=FX, fy=FY, model=model, coeffs=coeffs)
+    profile = types.SimpleNamespace(as_video_stream_profile=lambda: types.SimpleNamespace(intrinsics=intrinsics))
+    return types.SimpleNamespace(profile=profile, get_units=lambda: 0.001)
+
+
+@pytest.mark.parametrize("model, coeffs", [
+    ("none", [0, 0, 0, 0, 0]),
+    ("brown_conrady", [0, 0, 0, 0, 0]),
+    ("brown_conrady", [0.1, -0.05, 0.001, 0.002, 0.01]),
+    ("inverse_brown_conrady", [0.1, -0.05, 0.001, 0.002, 0.01]),
+    ("modified_brown_conrady", [0.1, 0, 0, 0, 0]),
+    ("kannala_brandt4", [0.05, -0.01, 0.002, -0.001, 0]),
+    ("ftheta", [0.9, 0, 0, 0, 0]),
+])
+def test_deproject_matches_librealsense(model, coeffs):
+    model = getattr(rs.distortion, model)
+    intrinsics = DepthIntrinsics(depth_frame(model, coeffs))
+    rng = np.random.default_rng(1)
+    pixels = rng.integers(0, [640, 480], (2, 21, 2))
+    depth = rng.uniform(0.3, 2, (2, 21))
+    points = intrinsics.deproject(pixels, depth)
+    assert points.shape == (2, 21, 3) and points.dtype == np.float32
+    expected = [[rs2_deproject_pixel_to_point(model, coeffs, pixel, z) for pixel, z in zip(hand, hand_depth)]
+                for hand, hand_depth in zip(pixels, depth)]
+    np.testing.assert_allclose(points, expected, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize("policy, kept", [(DROP_OLDEST, [2, 3]), (DROP_NEWEST, [1, 2])])
+def test_stage_queue_drops(policy, kept):
+    queue = StageQueue(2, policy)
+    for item in (1, 2, 3):
+        queue.put(item)
+    assert [queue.get(), queue.get()] == kept
+    assert queue.items_dropped == 1
+
+
+def test_stage_queue_blocks():
+    queue = StageQueue(1, DROP_NONE)
+    queue.put(1)
+    producer = threading.Thread(target=queue.put, args=(2,))
+    producer.start()
+    producer.join(0.1)
+    # Waiting for room instead of dropping
+    assert producer.is_alive()
+    assert queue.get() == 1
+    producer.join(1)
+    assert queue.get() == 2 and queue.items_dropped == 0
+    producer = threading.Thread(target=lambda: [queue.put(item) for item in (3, 4)])
+    producer.start()
+    time.sleep(0.05)
+    # Closing wakes the producer, the queue then gives None
+    queue.close()
+    producer.join(1)
+    assert not producer.is_alive()
+    assert queue.get() is None
+
+
+def test_stage_queue_arguments():
+    with pytest.raises(ValueError):
+        StageQueue(0)
+    with pytest.raises(ValueError):
+        StageQueue(1, 'random')
+
+
+def pipelined_tracker(monkeypatch):
+    """ A pipelined tracker over stand-in stages, without camera nor MediaPipe. """
+    monkeypatch.setattr(IntelHandTracker.cv2, 'destroyAllWindows', lambda: None)
+    tracker = IntelHandTracker.IntelHandTracker.__new__(IntelHandTracker.IntelHandTracker)
+    tracker.serial_number = "123"
+    tracker.metrics = None
+    tracker.stage_error = None
+    tracker.pipeline = types.SimpleNamespace(stop=lambda: None)
+
+    def capture():
+        time.sleep(0.005)
+        return "frames", time.time()
+    tracker._capture = capture
+    tracker._infer = lambda captured: captured
+    tracker._post_process = lambda inferred: (None, [], np.zeros((0, 21, 3), np.float32), inferred[1])
+    tracker.start_pipeline()
+    return tracker
+
+
+def test_pipeline_stops_on_a_stage_error(monkeypatch):
+    tracker = pipelined_tracker(monkeypatch)
+    frame, hands, serial_number = tracker.next_frame()
+    assert serial_number == "123" and tracker.capture_time is not None
+
+    def infer(captured):
+        raise ValueError("inference failed")
+    tracker._infer = infer
+    deadline = time.monotonic() + 5
+    while tracker.next_frame() is not None:
+        assert time.monotonic() < deadline
+    assert isinstance(tracker.stage_error, ValueError)
+    tracker.exit()
+
+
+def test_exit_stops_the_pipeline(monkeypatch):
+    tracker = pipelined_tracker(monkeypatch)
+    assert tracker.next_frame() is not None
+    threads = tracker._threads
+    tracker.exit()
+    assert threads and not any(thread.is_alive() for thread in threads)
+    assert tracker.stage_error is None
@@ -0,0 +1,45 @@
+import types
+from multiprocessing import shared_memory
+import numpy as np
+from TrackerPool import LABEL_NAMES, ResultBlock, _LOCK
+
+
+def hands(*labels):
+    return [types.SimpleNamespace(label=label) for label in labels]
+
+
+def points(nb_hands, value):
+    return np.arange(nb_hands * 21 * 3, dtype=np.float32).reshape(nb_hands, 21, 3) + value
+
+
+def test_result_block_round_trip():
+    block = shared_memory.SharedMemory(create=True, size=ResultBlock.size(2))
+    writer = ResultBlock(block.buf, 2)
+    reader = ResultBlock(block.buf, 2)
+    try:
+        writer.write(1, hands("right", "left"), points(2, 0.5), 1234.5)
+        seq, capture_time, labels, read_points = reader.read()
+        assert (seq, capture_time) == (1, 1234.5)
+        assert [LABEL_NAMES[label] for label in labels] == ["right", "left"]
+        np.testing.assert_array_equal(read_points, points(2, 0.5))
+        # Fewer hands, no capture time: the stale second hand is not read back
+        writer.write(2, hands(None), points(1, 7), None)
+        seq, capture_time, labels, read_points = reader.read()
+        assert (seq, capture_time, list(labels)) == (2, None, [0])
+        np.testing.assert_array_equal(read_points, points(1, 7))
+        # More hands than the block holds are cut
+        writer.write(3, hands("left", "right", "left"), points(3, 1), 1.0)
+        seq, capture_time, labels, read_points = reader.read()
+        assert seq == 3 and read_points.shape == (2, 21, 3)
+        np.testing.assert_array_equal(read_points, points(3, 1)[:2])
+        # An odd lock is a write in progress
+        lock, = _LOCK.unpack_from(block.buf, 0)
+        _LOCK.pack_into(block.buf, 0, lock + 1)
+        assert reader.read() is None
+        _LOCK.pack_into(block.buf, 0, lock + 2)
+        assert reader.read()[0] == 3
+    finally:
+        writer.release()
+        reader.release()
+        block.close()
+        block.unlink()
@@ -16,72 +16,87 @@ sys.path.append(script_dir+'/intel_hand_tracker')
 
 from HandTrackerRenderer import HandTrackerRenderer
 import argparse
+from unity_bridge import add_arguments, configure
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-p', '--port', type=int, help="Port")
+add_arguments(parser)
 parser_tracker = parser.add_argument_group("Tracker arguments")
 parser_tracker.add_argument('--internal_frame_height', type=int,                                                                                 
                     help="Internal color camera frame height in pixels")
 parser_tracker.add_argument('--internal_frame_width', type=int,                                                                                 
                     help="Internal color camera frame width in pixels")  
+parser_tracker.add_argument('--inference_width', type=int,
+                    help="Width of the image given to MediaPipe, downscaled from the color frame (default: full frame)")
+parser_tracker.add_argument('--inference_height', type=int,
+                    help="Height of the image given to MediaPipe (default: keeps the aspect ratio of the color frame)")
+parser_tracker.add_argument('--pipelined', action="store_true",
+                    help="Capture, inference and post-processing on their own threads, overlapping the camera wait and the inference")
+parser_tracker.add_argument('--queue_size', type=int, default=1,
+                    help="Pipelined mode: frames queued between two stages (default=%(default)i)")
+parser_tracker.add_argument('--drop_policy', choices=['oldest', 'newest', 'block'], default='oldest',
+                    help="Pipelined mode: frame dropped when a stage falls behind, or 'block' to drop none (default=%(default)s)")
 args = parser.parse_args()
 dargs = vars(args)
-tracker_args = {a:dargs[a] for a in ['internal_frame_height', 'internal_frame_width'] if dargs[a] is not None}
+tracker_args = {a:dargs[a] for a in ['internal_frame_height', 'internal_frame_width', 'inference_width', 'inference_height',
+                                        'pipelined', 'queue_size', 'drop_policy'] if dargs[a] is not None}
 
 from IntelHandTracker import IntelHandTracker
 
 
 # -- UB
+# Fields of the hands sent to Unity, clients can ask for a part of them with HELO "fields"
+HAND_FIELDS = ['label', 'xyz', 'rotated_world_landmarks']
 from unity_bridge import UnityBridge, TestObject
+from unity_bridge_protocol import READY_STREAMING
 # Unity Bridge Configuration
 # Example usage in the main application
 address = ('127.0.0.1', args.port)
 unity_bridge = UnityBridge(address)
+configure(unity_bridge, args)
 unity_bridge.start()
 test_object = TestObject(result="Success")
 # -- UB
 
-tracker = IntelHandTracker(args.port, **tracker_args)
+tracker = IntelHandTracker(args.port, metrics=unity_bridge.metrics,
+                           on_streaming=lambda: unity_bridge.set_ready(READY_STREAMING), **tracker_args)
 if not tracker.created:
     sys.exit()
 
 #renderer = HandTrackerRenderer(tracker=tracker)
 count = 0
 
-while True:
-    # Run hand tracker on next frame
-    # 'bag' contains some information related to the frame 
-    # and not related to a particular hand like body keypoints in Body Pre Focusing mode
-    # Currently 'bag' contains meaningful information only when Body Pre Focusing is used
-    frame, hands, serialNumber = tracker.next_frame()
-    if frame is None: break
-        # Draw hands
-    #frame = renderer.draw(frame, hands)
+try:
+    while True:
+        # Run hand tracker on next frame
+        # 'bag' contains some information related to the frame 
+        # and not related to a particular hand like body keypoints in Body Pre Focusing mode
+        # Currently 'bag' contains meaningful information only when Body Pre Focusing is used
+        result = tracker.next_frame()
+        if result is None:
+            # Incomplete frameset, or the pipelined mode stopped
+            if tracker.stage_error is not None:
+                break
+            continue
+        frame, hands, serialNumber = result
+        if frame is None: break
+            # Draw hands
+        #frame = renderer.draw(frame, hands)
 
-    # -- UB
-    # Prepare data for serialization
-    test_object.arr1 = [count]
-    count = count+1
-    if len(hands)==1:
-        names = ['hand_0','res2']
-        objects = [hands[0],test_object]
-        configs = [['label','xyz','rotated_world_landmarks'],['result','arr1']]  # List of fields to serialize for each object
-    elif len(hands)==2:
-        names = ['hand_0','hand_1','res2']
-        objects = [hands[0],hands[1],test_object]
-        configs = [['label','xyz','rotated_world_landmarks'],['xyz','label','rotated_world_landmarks'],['result','arr1']]  # List of fields to serialize for each object
-    else:
-        names = ['res2']
-        objects = [test_object]
-        configs = [['result','arr1']]  # List of fields to serialize for each object
+        # -- UB
+        # Prepare data for serialization
+        test_object.arr1 = [count]
+        count = count+1
 
-    # Send data back to Unity
-    #frame_ub = cv2.resize(frame,(576,324))
-    unity_bridge.send(names, objects, configs, serialNumber)
-    # -- UB
+        # Send data back to Unity: hand_0, hand_1 with the subscribed HAND_FIELDS, and res2
+        #frame_ub = cv2.resize(frame,(576,324))
+        unity_bridge.send_hands(hands[:2], HAND_FIELDS, serialNumber, frame,
+                                ['res2'], [test_object], [['result','arr1']], tracker.capture_time)
+        # -- UB
 
-    #key = renderer.waitKey(delay=1)
-    #if key == 27 or key == ord('q'):
-    #    break
-#renderer.exit()
-tracker.exit()
+        #key = renderer.waitKey(delay=1)
+        #if key == 27 or key == ord('q'):
+        #    break
+finally:
+    #renderer.exit()
+    tracker.exit()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+# Replays a log recorded with --record through a UnityBridge, no camera needed.
+#
+# python replay_unity_bridge.py session.ubr -p 12345              original pacing
+# python replay_unity_bridge.py session.ubr -p 12345 --speed 2    twice as fast
+# python replay_unity_bridge.py session.ubr -p 12345 --speed 0    as fast as possible
+
+import sys
+import os
+import argparse
+import time
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(script_dir)
+
+from unity_bridge import UnityBridge, add_arguments, configure
+from unity_bridge_record import read_frames
+from unity_bridge_protocol import READY_STREAMING
+
+parser = argparse.ArgumentParser()
+parser.add_argument('log', help="Log file recorded with --record")
+parser.add_argument('-p', '--port', type=int, required=True, help="Port")
+parser.add_argument('-s', '--speed', type=float, default=1.0,
+                    help="Playback speed factor, 0 for as fast as possible (default=%(default)s)")
+parser.add_argument('--loop', action="store_true", help="Replay the log again and again")
+parser.add_argument('--wait_client', action="store_true", help="Start the replay when a first client connects")
+add_arguments(parser, images=False, record=False)
+args = parser.parse_args()
+
+address = ('127.0.0.1', args.port)
+unity_bridge = UnityBridge(address)
+configure(unity_bridge, args)
+unity_bridge.start()
+# The log plays the part of the camera
+unity_bridge.set_ready(READY_STREAMING)
+if args.wait_client:
+    while not unity_bridge.clients:
+        time.sleep(0.05)
+
+try:
+    while True:
+        count = 0
+        start = time.monotonic()
+        first_timestamp = None
+        for seq, timestamp, data in read_frames(args.log):
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            if args.speed > 0:
+                # Original spacing of the frames, scaled, from the start of this pass
+                delay = start + (timestamp - first_timestamp) / 1000000 / args.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            # Same delay between capture and publication as when recorded
+            capture_time = None
+            if "captureTime" in data and "publishTime" in data:
+                capture_time = time.time() - (data["publishTime"] - data["captureTime"]) / 1000000
+            unity_bridge.publish(data, data.get("serialNumber"), capture_time=capture_time)
+            count = count + 1
+        elapsed = time.monotonic() - start
+        print(f"Replayed {count} frames in {elapsed:.2f}s ({count / elapsed if elapsed else 0:.0f} frames/s)")
+        if not args.loop or count == 0:
+            break
+except KeyboardInterrupt:
+    pass
+unity_bridge.close()
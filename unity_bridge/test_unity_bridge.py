@@ -66,7 +66,7 @@ with dai.Device(pipeline) as device:
         # Unity Bridge part
         test_object2.arr1 = [unity_bridge.count]
         # Send data back to Unity
-        unity_bridge.send(inRgb.getCvFrame(), names, objects, configs)
+        unity_bridge.send(names, objects, configs, device.getMxId(), inRgb.getCvFrame())
 
 
         if cv2.waitKey(1) == ord('q'):
@@ -0,0 +1,403 @@
+import socket
+import threading
+import time
+import numpy as np
+import pytest
+import unity_bridge_protocol as ubp
+import unity_bridge as ub
+from unity_bridge_client import FrameClient, UdpFrameReceiver
+
+# The bridge protocol, through a UnityBridge and FrameClients over loopback
+
+QUANTUM = 0.0005
+LANDMARKS = np.linspace(-0.5, 0.5, 63).reshape(21, 3)
+
+
+@pytest.fixture
+def bridge():
+    bridge = ub.UnityBridge(('127.0.0.1', 0), poll_interval=0, delta_keyframe_interval=3, delta_quantum=QUANTUM)
+    bridge.start()
+    assert bridge.wait_ready(ubp.READY_LISTENING, 5)
+    yield bridge
+    bridge.close()
+
+
+def connect(bridge, options=None):
+    # The bridge was bound to port 0, its address keeps the port it was given
+    return FrameClient(bridge.socket.getsockname(), options)
+
+
+def record_types(client):
+    """ Message types and flags read by the client, in order. """
+    seen = []
+    read_message = client._read_message
+
+    def _read_message():
+        message = read_message()
+        seen.append(message[:2])
+        return message
+    client._read_message = _read_message
+    return seen
+
+
+def hand(shift, label="right"):
+    return {"label": label, "xyz": [0.1 + shift, -0.2, 0.6 - shift], "landmarks": LANDMARKS + shift}
+
+
+def assert_frame(received, sent, atol):
+    assert set(received) == set(sent) | {"publishTime"}
+    for key, value in sent.items():
+        if isinstance(value, dict):
+            assert set(received[key]) == set(value)
+            for field, field_value in value.items():
+                if isinstance(field_value, str):
+                    assert received[key][field] == field_value
+                else:
+                    np.testing.assert_allclose(np.asarray(received[key][field], dtype=np.float64),
+                                               field_value, rtol=0, atol=atol)
+        else:
+            assert received[key] == value
+
+
+def test_unanswerable_requests_do_not_spin(bridge):
+    before_first_frame = connect(bridge, {"framing": "header"})
+    before_first_frame.socket.sendall(ubp.CMD_DATA)
+    other_camera = connect(bridge, {"framing": "header", "cameras": ["other"]})
+    other_camera.socket.sendall(ubp.CMD_DATA)
+    start = time.process_time()
+    time.sleep(0.5)
+    assert time.process_time() - start < 0.2
+    bridge.publish({"serialNumber": "cam"}, "cam")
+    assert before_first_frame.receive()[2]["serialNumber"] == "cam"
+    start = time.process_time()
+    time.sleep(0.5)
+    assert time.process_time() - start < 0.2
+    bridge.publish({"serialNumber": "other"}, "other")
+    assert other_camera.receive()[2]["serialNumber"] == "other"
+
+
+def test_unencodable_frame_is_skipped(bridge):
+    client = connect(bridge, {"framing": "header"})
+    client.subscribe()
+    bridge.publish({"serialNumber": "cam", "arr1": {1, 2}}, "cam")
+    deadline = time.monotonic() + 5
+    while not bridge.metrics.counters.get('frames_unencodable_total') and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert bridge.metrics.counters['frames_unencodable_total'] == 1
+    # Not raised into the publishers, the next frame goes out
+    bridge.publish({"serialNumber": "cam", "arr1": [3]}, "cam")
+    assert client.receive()[2]["arr1"] == [3]
+
+
+def test_binary_encoding_round_trip():
+    data = {"serialNumber": "123", "count": 7, "hand_0": {"label": "left", "xyz": [0.1, 0.2, 0.3],
+                                                         "landmarks": LANDMARKS, "score": 0.9, "empty": []}}
+    decoded = ubp.decode_binary(ubp.encode_binary(data))
+    assert decoded["serialNumber"] == "123" and decoded["count"] == 7
+    assert decoded["hand_0"]["label"] == "left" and decoded["hand_0"]["empty"] == []
+    assert decoded["hand_0"]["landmarks"].dtype == np.float32 and decoded["hand_0"]["landmarks"].shape == (21, 3)
+    np.testing.assert_allclose(decoded["hand_0"]["landmarks"], LANDMARKS, rtol=1e-6)
+    np.testing.assert_allclose(decoded["hand_0"]["xyz"], [0.1, 0.2, 0.3], rtol=1e-6)
+    np.testing.assert_allclose(decoded["hand_0"]["score"], 0.9, rtol=1e-6)
+
+
+def test_binary_frames_over_loopback(bridge):
+    client = connect(bridge, {"framing": "header", "encoding": "binary"})
+    client.subscribe()
+    for shift in (0.0, 0.01):
+        frame = {"serialNumber": "cam", "hand_0": hand(shift)}
+        bridge.publish(frame, "cam")
+        seq, timestamp, data = client.receive()
+        assert seq == bridge.frame_seq
+        assert_frame(data, frame, 1e-6)
+
+
+def test_binary_encoding_needs_the_header_framing(bridge):
+    with pytest.raises(ValueError):
+        connect(bridge, {"encoding": "binary"})
+
+
+def test_wait_long_poll(bridge):
+    client = connect(bridge, {"framing": "header"})
+    bridge.publish({"serialNumber": "cam", "arr1": [1]}, "cam")
+    seq, timestamp, data = client.wait(0)
+    assert data["arr1"] == [1]
+    publisher = threading.Timer(0.2, bridge.publish, ({"serialNumber": "cam", "arr1": [2]}, "cam"))
+    publisher.start()
+    start = time.monotonic()
+    # Answered by the next frame, not by the one already seen
+    assert client.wait(seq)[2]["arr1"] == [2]
+    assert time.monotonic() - start >= 0.15
+    publisher.join()
+
+
+def test_sent_values_are_copied(bridge):
+    client = connect(bridge, {"framing": "header"})
+    test_object = ub.TestObject(result="Success")
+    test_object.arr1 = [1, 2]
+    bridge.send(['res'], [test_object], [['result', 'arr1']], "cam")
+    # The tracker keeps modifying its objects after send()
+    test_object.arr1.append(3)
+    test_object.result = "Changed"
+    assert client.request()[2]["res"] == {"result": "Success", "arr1": [1, 2]}
+
+
+def test_delta_frames_over_loopback(bridge):
+    client = connect(bridge, {"framing": "header", "delta": True})
+    assert client.hello["delta"] and client.hello["quantum"] == QUANTUM
+    seen = record_types(client)
+    client.subscribe()
+    frames = [{"serialNumber": "cam", "hand_0": hand(0.0)},
+              {"serialNumber": "cam", "hand_0": hand(0.0003), "hand_1": hand(0.1, "left")},
+              {"serialNumber": "cam", "hand_0": hand(0.0107), "hand_1": hand(0.1, "left")},
+              # hand_1 lost, a field of hand_0 removed, a label changed
+              {"serialNumber": "cam", "hand_0": {"label": "left", "xyz": [0.0, 0.0, 0.5]}},
+              {"serialNumber": "cam", "hand_0": hand(0.02)},
+              {"serialNumber": "cam", "hand_0": hand(0.0201), "hand_1": hand(-0.1, "left")},
+              {"serialNumber": "cam"},
+              {"serialNumber": "cam", "hand_0": hand(0.03)}]
+    for frame in frames:
+        bridge.publish(frame, "cam")
+        seq, timestamp, data = client.receive()
+        assert seq == bridge.frame_seq
+        assert_frame(data, frame, QUANTUM)
+    types = [msg_type for msg_type, flags in seen if msg_type in (ubp.MSG_DATA, ubp.MSG_DELTA)]
+    assert ubp.MSG_DELTA in types
+    # The first frame, then a keyframe every 3 deltas at most
+    assert types[0] == ubp.MSG_DATA and types.count(ubp.MSG_DATA) >= 2
+
+
+def test_invalid_keyframe_interval(bridge):
+    for keyframe_interval in ("x", 0, True, 2.5):
+        with pytest.raises(ValueError):
+            connect(bridge, {"framing": "header", "delta": True, "keyframe_interval": keyframe_interval})
+    client = connect(bridge, {"framing": "header", "delta": True, "keyframe_interval": 2})
+    assert client.hello["keyframe_interval"] == 2
+
+
+def test_udp_datagrams(bridge):
+    receiver = UdpFrameReceiver('127.0.0.1')
+    client = connect(bridge, {"framing": "header", "encoding": "binary", "udp_port": receiver.port})
+    assert client.hello["udp_port"] == receiver.port
+    frame = {"serialNumber": "cam", "hand_0": hand(0.0)}
+    bridge.publish(frame, "cam")
+    seq, timestamp, data = receiver.receive(5)
+    assert seq == bridge.frame_seq
+    assert_frame(data, frame, 1e-6)
+    receiver.socket.close()
+
+
+@pytest.mark.parametrize("options", [{"encoding": "binary", "udp_port": "abc"},
+                                     {"encoding": "binary", "udp_port": 70000},
+                                     {"encoding": "binary", "udp_port": True},
+                                     # A JSON frame does not fit in a datagram
+                                     {"udp_port": 9999}])
+def test_invalid_udp_port(bridge, options):
+    with pytest.raises(ValueError):
+        connect(bridge, dict(options, framing="header"))
+    bridge.publish({"serialNumber": "cam"}, "cam")
+    assert connect(bridge, {"framing": "header"}).request()[2]["serialNumber"] == "cam"
+
+
+def test_unacknowledged_frames_hold_back_the_client(bridge):
+    bridge.max_unacked = 2
+    client = FrameClient(bridge.socket.getsockname(), {"framing": "header"}, acknowledge=True)
+    client.subscribe()
+    bridge.publish({"serialNumber": "cam", "arr1": [1]}, "cam")
+    assert client.receive()[2]["arr1"] == [1]
+    # The client stops acknowledging: two more frames, then the bridge skips the new ones
+    client.acknowledge = False
+    for i in range(2, 7):
+        bridge.publish({"serialNumber": "cam", "arr1": [i]}, "cam")
+        time.sleep(0.05)
+    assert [client.receive()[2]["arr1"] for _ in range(2)] == [[2], [3]]
+    client.socket.settimeout(0.2)
+    with pytest.raises(socket.timeout):
+        client.receive()
+    stats, = bridge.client_stats()
+    assert stats["frames_unacked"] == 2 and stats["frames_delivered"] == 3
+    # Acknowledging catches up with the newest frame, the ones in between are dropped
+    client.socket.settimeout(5)
+    client.socket.sendall(ubp.CMD_ACK + ubp.COMMAND_SEQ.pack(bridge.frame_seq - 3))
+    assert client.receive()[2]["arr1"] == [6]
+    time.sleep(0.05)
+    stats, = bridge.client_stats()
+    assert stats["frames_dropped"] == 2 and stats["frames_delivered"] == 4
+
+
+def test_clients_choose_their_cameras(bridge):
+    bridge.publish({"serialNumber": "A", "arr1": [1]}, "A")
+    bridge.publish({"serialNumber": "B", "arr1": [1]}, "B")
+    only_b = connect(bridge, {"framing": "header", "cameras": ["B"]})
+    assert only_b.hello["cameras"] == ["A", "B"] and only_b.hello["subscribed"] == ["B"]
+    every_camera = connect(bridge, {"framing": "header"})
+    # A request gets the last frame of every subscribed camera
+    assert only_b.request()[2]["serialNumber"] == "B"
+    every_camera.socket.sendall(ubp.CMD_DATA)
+    assert sorted(every_camera.receive()[2]["serialNumber"] for _ in range(2)) == ["A", "B"]
+    only_b.subscribe()
+    every_camera.subscribe()
+    bridge.publish({"serialNumber": "A", "arr1": [2]}, "A")
+    bridge.publish({"serialNumber": "B", "arr1": [2]}, "B")
+    assert only_b.receive()[2] == {"serialNumber": "B", "arr1": [2], "publishTime": bridge.snapshots["B"].timestamp}
+    assert [every_camera.receive()[2]["serialNumber"] for _ in range(2)] == ["A", "B"]
+    with pytest.raises(ValueError):
+        connect(bridge, {"framing": "header", "cameras": "B"})
+
+
+@pytest.mark.parametrize("encoding", ["json", "binary"])
+def test_compressed_stream_over_loopback(bridge, encoding):
+    client = connect(bridge, {"framing": "header", "encoding": encoding, "compression": "zlib"})
+    assert client.hello["compression"] == "zlib"
+    seen = record_types(client)
+    client.subscribe()
+    # Frames over and under the compression threshold share the zlib stream of the connection
+    frames = [{"serialNumber": "cam", "hand_0": hand(0.0), "hand_1": hand(0.1, "left")},
+              {"serialNumber": "cam"},
+              {"serialNumber": "cam", "hand_0": hand(0.01), "hand_1": hand(0.11, "left")},
+              {"serialNumber": "cam", "hand_0": hand(0.02)}]
+    for frame in frames:
+        bridge.publish(frame, "cam")
+        seq, timestamp, data = client.receive()
+        assert_frame(data, frame, 1e-6)
+    flags = [flags & ubp.FLAG_COMPRESSED for msg_type, flags in seen if msg_type == ubp.MSG_DATA]
+    assert flags[0] and not flags[1]
+
+
+def test_compressed_delta_frames(bridge):
+    client = connect(bridge, {"framing": "header", "delta": True, "compression": "zlib"})
+    client.subscribe()
+    for shift in np.linspace(0, 0.05, 6):
+        frame = {"serialNumber": "cam", "hand_0": hand(shift)}
+        bridge.publish(frame, "cam")
+        seq, timestamp, data = client.receive()
+        assert_frame(data, frame, QUANTUM)
+
+
+def test_unknown_compression(bridge):
+    with pytest.raises(ValueError):
+        connect(bridge, {"framing": "header", "compression": "lz4"})
+
+
+@pytest.mark.parametrize("policy, atol", [("d2", 0.005), ("mm", 0.0005), ("f16", 0.0005)])
+@pytest.mark.parametrize("encoding", ["json", "binary"])
+def test_precision_policies(bridge, policy, atol, encoding):
+    client = connect(bridge, {"framing": "header", "encoding": encoding})
+    test_object = ub.TestObject(result="Success")
+    test_object.xyz = np.array([0.123456, -0.456789, 0.789012])
+    test_object.arr1 = (LANDMARKS * 0.987654).tolist()
+    bridge.send(['hand_0'], [test_object], [['result', f'xyz:{policy}', f'arr1:{policy}']], "cam")
+    seq, timestamp, data = client.request()
+    assert data["hand_0"]["result"] == "Success"
+    np.testing.assert_allclose(np.asarray(data["hand_0"]["xyz"], dtype=np.float64), test_object.xyz, rtol=0, atol=atol)
+    np.testing.assert_allclose(np.asarray(data["hand_0"]["arr1"], dtype=np.float64), test_object.arr1, rtol=0, atol=atol)
+
+
+def test_smaller_binary_blocks():
+    data = {"hand_0": {"landmarks": LANDMARKS}}
+    full = len(ubp.encode_binary(data))
+    for policy in (ubp.PRECISION_MM, ubp.PRECISION_FLOAT16):
+        payload = ubp.encode_binary(data, {("hand_0", "landmarks"): policy})
+        # 2 bytes a value instead of 4
+        assert full - len(payload) == LANDMARKS.size * 2
+        decoded = ubp.decode_binary(payload)["hand_0"]["landmarks"]
+        assert decoded.dtype == np.float32
+        np.testing.assert_allclose(decoded, LANDMARKS, rtol=0, atol=0.0005)
+
+
+def test_unknown_precision_policy(bridge):
+    with pytest.raises(ValueError):
+        bridge.send(['hand_0'], [ub.TestObject(result="Success")], [['arr1:d10']], "cam")
+
+
+class TrackedHand:
+    calls = 0
+
+    def __init__(self, label, xyz):
+        self.label = label
+        self.xyz = np.array(xyz)
+
+    def get_rotated_world_landmarks(self):
+        TrackedHand.calls += 1
+        return LANDMARKS
+
+
+def test_unsubscribed_fields_are_not_read(bridge):
+    hand_fields = ['label', 'xyz', 'get_rotated_world_landmarks']
+    hands = [TrackedHand("right", [0.1, 0.2, 0.3]), TrackedHand("left", [0.4, 0.5, 0.6])]
+    client = connect(bridge, {"framing": "header", "fields": ["xyz"], "max_hands": 1})
+    assert client.hello["fields"] == ["xyz"] and client.hello["max_hands"] == 1
+    TrackedHand.calls = 0
+    bridge.send_hands(hands, hand_fields, "cam")
+    data = client.request()[2]
+    assert set(data) == {"hand_0", "serialNumber", "publishTime"}
+    assert set(data["hand_0"]) == {"xyz"}
+    assert TrackedHand.calls == 0
+    # A client asking for every field gets them from the next frame on
+    every_field = connect(bridge, {"framing": "header"})
+    bridge.send_hands(hands, hand_fields, "cam")
+    data = every_field.request()[2]
+    assert set(data["hand_1"]) == {"label", "xyz", "rotated_world_landmarks"}
+    assert TrackedHand.calls == 2
+    assert set(client.request()[2]["hand_0"]) == {"xyz"}
+
+
+@pytest.mark.parametrize("options", [{"fields": "xyz"}, {"max_hands": -1}, {"max_hands": "2"}])
+def test_invalid_subscription(bridge, options):
+    with pytest.raises(ValueError):
+        connect(bridge, dict(options, framing="header"))
+
+
+class Hand:
+    def __init__(self, label, xyz):
+        self.label = label
+        self.xyz = np.array(xyz)
+
+
+def test_prediction_tells_hands_apart_without_subscribed_label(bridge):
+    bridge.enable_prediction()
+    client = connect(bridge, {"framing": "header", "fields": ["xyz"], "predict_ms": 100})
+    client.subscribe()
+    left, right = Hand("left", [0.0, 0.1, 0.5]), Hand("right", [0.3, 0.1, 0.5])
+    start = time.time()
+    for i in range(6):
+        # MediaPipe does not keep the order of the hands from frame to frame
+        hands = [left, right] if i % 2 else [right, left]
+        bridge.send_hands(hands, ['label', 'xyz'], "cam", capture_time=start + i / 30)
+        data = client.receive()[2]
+        for key, hand in zip(("hand_0", "hand_1"), hands):
+            assert set(data[key]) == {"xyz"}
+            np.testing.assert_allclose(data[key]["xyz"], hand.xyz, atol=1e-9)
+
+
+def test_clock_sync(bridge):
+    client = connect(bridge, {"framing": "header"})
+    # Same host, same clock
+    assert abs(client.sync_clock()) < 5000
+    assert 0 <= client.clock_rtt < 100000
+
+
+def test_capture_time_and_prediction(bridge):
+    bridge.enable_prediction()
+    plain = connect(bridge, {"framing": "header"})
+    predicted = connect(bridge, {"framing": "header", "predict_ms": 100})
+    assert predicted.hello["predict_ms"] == 100
+    moving = Hand("right", [0.0, 0.1, 0.5])
+    start = time.time()
+    for i in range(4):
+        # 0.3 m/s along x
+        moving.xyz = np.array([0.01 * i, 0.1, 0.5])
+        bridge.send_hands([moving], ['label', 'xyz'], "cam", capture_time=start + i / 30)
+    data = plain.request()[2]
+    assert data["captureTime"] == ubp.timestamp_us(start + 3 / 30)
+    np.testing.assert_allclose(data["hand_0"]["xyz"], moving.xyz)
+    np.testing.assert_allclose(predicted.request()[2]["hand_0"]["xyz"], moving.xyz + [0.03, 0, 0], atol=1e-6)
+
+
+def test_invalid_predict_ms(bridge):
+    with pytest.raises(ValueError):
+        connect(bridge, {"framing": "header", "predict_ms": 100})
+    bridge.enable_prediction()
+    for predict_ms in ("100", -1, 5000):
+        with pytest.raises(ValueError):
+            connect(bridge, {"framing": "header", "predict_ms": predict_ms})
@@ -0,0 +1,27 @@
+import pytest
+from unity_bridge import FrameSnapshot
+from unity_bridge_record import FrameRecorder, read_frames
+
+
+def record(path, seqs):
+    recorder = FrameRecorder(path)
+    for seq in seqs:
+        recorder.record(FrameSnapshot(seq, 1000 * seq, {"serialNumber": "cam", "arr1": [seq]}, "cam"))
+    recorder.close()
+
+
+def test_recording_is_appended_to(tmp_path):
+    path = str(tmp_path / "frames.ubrc")
+    record(path, [1, 2])
+    record(path, [3])
+    assert [(seq, timestamp, data["arr1"]) for seq, timestamp, data in read_frames(path)] == \
+        [(1, 1000, [1]), (2, 2000, [2]), (3, 3000, [3])]
+
+
+@pytest.mark.parametrize("content", [b"not a recording", b"UBRC\x02\x00\x00\x00", b"UB"])
+def test_other_files_are_not_appended_to(tmp_path, content):
+    path = tmp_path / "frames.ubrc"
+    path.write_bytes(content)
+    with pytest.raises(ValueError):
+        FrameRecorder(str(path))
+    assert path.read_bytes() == content
@@ -0,0 +1,71 @@
+import threading
+import numpy as np
+from unity_bridge import FrameSnapshot
+from unity_bridge_shm import ShmRingReader, ShmRingWriter
+
+SLOTS = 4
+IMAGE_SHAPE = (48, 64, 3)
+
+
+def snapshot(seq):
+    data = {"serialNumber": "cam", "hand_0": {"label": "right", "xyz": [0.1, 0.2, seq],
+                                             "rotated_world_landmarks": np.full((21, 3), seq, dtype=np.float32)}}
+    if seq % 2:
+        data["hand_1"] = {"label": "left", "xyz": [-0.1, 0.2, seq], "landmarks": np.full((21, 3), -seq)}
+    return FrameSnapshot(seq, 1000 * seq, data, "cam")
+
+
+def image(seq):
+    return np.full(IMAGE_SHAPE, seq, dtype=np.uint8)
+
+
+def assert_latest(frame, seq):
+    assert frame["seq"] == seq
+    assert frame["timestamp"] == 1000 * seq
+    assert frame["serialNumber"] == "cam"
+    assert [hand["label"] for hand in frame["hands"]] == (["right", "left"] if seq % 2 else ["right"])
+    np.testing.assert_array_equal(frame["hands"][0]["xyz"], np.float32([0.1, 0.2, seq]))
+    np.testing.assert_array_equal(frame["hands"][0]["landmarks"], np.full((21, 3), seq))
+    if seq % 2:
+        np.testing.assert_array_equal(frame["hands"][1]["landmarks"], np.full((21, 3), -seq))
+    np.testing.assert_array_equal(frame["image"], image(seq))
+
+
+def test_ring_wraps_to_the_latest_frame(tmp_path):
+    path = str(tmp_path / "ring.shm")
+    writer = ShmRingWriter(path, SLOTS, 2, IMAGE_SHAPE)
+    reader = ShmRingReader(path)
+    try:
+        assert reader.read_latest() is None
+        assert reader.wait_for(0, timeout=0.01) is None
+        # Past the end of the ring a few times, every slot rewritten
+        for seq in range(1, 3 * SLOTS + 2):
+            writer.write_snapshot(snapshot(seq), image(seq))
+            assert_latest(reader.read_latest(), seq)
+        last = 3 * SLOTS + 1
+        assert_latest(reader.wait_for(last - 1, timeout=1), last)
+        assert reader.wait_for(last, timeout=0.01) is None
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_wait_for_a_frame_written_by_another_thread(tmp_path):
+    path = str(tmp_path / "ring.shm")
+    writer = ShmRingWriter(path, SLOTS, 2, IMAGE_SHAPE)
+    reader = ShmRingReader(path)
+    last = 2 * SLOTS + 3
+
+    def write():
+        for seq in range(1, last):
+            writer.write_snapshot(snapshot(seq), image(seq))
+        # A larger frame is resized to the image kept by the slots
+        writer.write_snapshot(snapshot(last), np.full((IMAGE_SHAPE[0] * 2, IMAGE_SHAPE[1] * 2, 3), last, dtype=np.uint8))
+    thread = threading.Thread(target=write)
+    try:
+        thread.start()
+        assert_latest(reader.wait_for(last - 1, timeout=5), last)
+        thread.join()
+    finally:
+        reader.close()
+        writer.close()
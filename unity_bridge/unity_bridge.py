@@ -2,152 +2,1219 @@ import socket
 import json
 from types import NoneType
 import cv2
-import _thread as thread
+import selectors
+import threading
 import time
 import numpy as np
 import re
+import inspect
+import zlib
+from collections import deque, OrderedDict
+import operator
+import unity_bridge_protocol as ubp
+from unity_bridge_image import ImageEncoder
+import unity_bridge_shm
+from unity_bridge_record import FrameRecorder
+from unity_bridge_metrics import Metrics
+
+# Upper bound for one select() call, so close() is noticed quickly
+_SELECT_TIMEOUT = 0.5
+_RECV_SIZE = 4096
+
+# Client commands, 4 ASCII bytes each. Any other command is handled as DATA.
+CMD_DATA = ubp.CMD_DATA  # request/response: answer once with the current results
+CMD_SUBSCRIBE = ubp.CMD_SUBSCRIBE  # push mode: every later send() is streamed right away
+CMD_HELLO = ubp.CMD_HELLO  # handshake, followed by a length-prefixed JSON object of options
+CMD_WAIT = ubp.CMD_WAIT  # long poll: answer with the first frame newer than the given sequence number
+CMD_ACK = ubp.CMD_ACK  # the client decoded the frame with the given sequence number (delta mode, backpressure)
+CMD_TIME = ubp.CMD_TIME  # clock offset measure, answered right away with MSG_TIME
+
+# Frames sent in delta mode and not acknowledged yet, kept per client
+_DELTA_HISTORY = 64
+_MISSING = object()
+# Keys of the hands sent with send_hands(): hand_0, hand_1...
+_HAND_PREFIX = 'hand_'
+# Errors raised while encoding a frame: values the encoders do not support (e.g. a set)
+_ENCODING_ERRORS = (TypeError, ValueError, OverflowError)
+# Hand fields extrapolated for the clients asking for HELO "predict_ms"
+_PREDICTED_FIELDS = ('xyz', 'rotated_world_landmarks', 'world_landmarks')
+
+
+class _RateMeter:
+    """ Events per second, exponentially smoothed over the intervals between events. """
+    def __init__(self, smoothing=0.1):
+        self.smoothing = smoothing
+        self.rate = 0.0
+        self._last = None
+
+    def tick(self, now):
+        if self._last is not None and now > self._last:
+            rate = 1.0 / (now - self._last)
+            self.rate = rate if not self.rate else self.rate + self.smoothing * (rate - self.rate)
+        self._last = now
+
+
+class _Predictor:
+    """ Velocity of the predicted fields of every hand, smoothed over the frames of its camera.
+
+    Hands are told apart by label ("left", "right"), or by key when they have
+    none. A hand missing from a frame, or seen again after more than max_gap
+    seconds, starts again without velocity.
+    """
+    def __init__(self, smoothing=0.5, max_gap=0.2):
+        self.smoothing = smoothing
+        self.max_gap = max_gap
+        # (serial, hand) -> (time, {field: (value, velocity or None)})
+        self.hands = {}
+        self._lock = threading.Lock()
+
+    def update(self, serial, data, t):
+        """ Velocities of the hands of a new frame taken at t (seconds), as {(key, field): velocity}. """
+        velocities = {}
+        seen = {}
+        with self._lock:
+            for key, value in data.items():
+                if not key.startswith(_HAND_PREFIX) or not isinstance(value, dict):
+                    continue
+                hand = (serial, value.get("label", key))
+                if hand in seen:
+                    hand = (serial, key)
+                previous = self.hands.get(hand)
+                dt = t - previous[0] if previous is not None else 0
+                fields = {}
+                for field in _PREDICTED_FIELDS:
+                    array = ubp.float_array(value.get(field))
+                    if array is None:
+                        continue
+                    velocity = None
+                    last = previous[1].get(field) if previous is not None and 0 < dt <= self.max_gap else None
+                    if last is not None and last[0].shape == array.shape:
+                        velocity = (array - last[0]) / dt
+                        if last[1] is not None:
+                            velocity = last[1] + self.smoothing * (velocity - last[1])
+                        velocities[(key, field)] = velocity
+                    fields[field] = (array, velocity)
+                seen[hand] = (t, fields)
+            # The hands of the camera missing from this frame are forgotten
+            self.hands = {hand: state for hand, state in self.hands.items() if hand[0] != serial}
+            self.hands.update(seen)
+        return velocities
+
+
+class _ClientConnection:
+    """ State kept by the event loop for one connected Unity client. """
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.inbuf = bytearray()
+        # Encoded messages waiting to be sent, as (bytes, seq) pairs. The bytes are
+        # shared with the other clients, so they are never copied or modified,
+        # out_offset tells how much of the first one was already sent. seq is set
+        # on the last message of a frame.
+        self.outqueue = deque()
+        self.out_offset = 0
+        self.out_bytes = 0
+        # Backpressure: frames queued but not completely written to the socket yet,
+        # and frames not acknowledged yet by a client that sends ACKN
+        self.frames_in_flight = 0
+        self.unacked = deque(maxlen=_DELTA_HISTORY)
+        self.acknowledging = False
+        self.frames_delivered = 0
+        self.frames_dropped = 0
+        self.delivery_rate = _RateMeter()
+        self.ack_rate = _RateMeter()
+        # DATA requests received but not answered yet
+        self.pending_requests = 0
+        # Earliest time the next answer can be sent (see UnityBridge.poll_interval)
+        self.next_send_time = 0.0
+        # Push mode, set by the SUBS command
+        self.streaming = False
+        # Long poll, sequence number given with WAIT until a newer frame is sent
+        self.wait_seq = None
+        # _DeltaState when the client asked for delta frames in HELO
+        self.delta = None
+        # Header framing only: MSG_IMAGE messages requested in HELO
+        self.images = False
+        # Sequence numbers of the last frame and image queued for the client
+        self.sent_seq = 0
+        self.image_seq = 0
+        # Serial numbers of the cameras subscribed to with HELO "cameras", None for all
+        self.cameras = None
+        # Per camera: FrameSnapshot.camera_seq of the last frame queued, to count the skipped ones
+        self.camera_seqs = {}
+        # UDP mode: (host, port) receiving one datagram per frame, set with HELO "udp_port"
+        self.udp_addr = None
+        self.udp_seq = 0
+        self.udp_oversize = 0
+        # UnityBridge.status_version of the last MSG_STATUS sent (header framing)
+        self.status_version = 0
+        # Subscription sent with HELO: (published hand fields, max number of hands,
+        # prediction horizon in seconds), None when the client gets every frame as
+        # published, see FrameSnapshot.view()
+        self.view = None
+        # Bridge time (microseconds) the last packet was received, for the answer to TIME
+        self.recv_time = 0
+        # Message framing and payload encoding, negotiated with HELO (see unity_bridge_protocol)
+        self.framing = ubp.FRAMING_SENTINEL
+        self.encoding = ubp.ENCODING_JSON
+        # zlib compressor kept for the whole connection, so the keys repeated in every
+        # frame stay in its window. Frames must be compressed in the order they are sent.
+        self.compressor = None
+        self.compressed_in = 0
+        self.compressed_out = 0
+
+
+class _SerializationPlan:
+    """ Accessors for one (object type, config) pair, built once and reused for every frame.
+
+    Fields that are methods of the class (e.g. 'get_rotated_world_landmarks') are
+    called and published without their 'get_' prefix, other fields are read as
+    attributes. Attributes missing on an object are recorded in `missing`.
+    A field can carry a precision policy, 'xyz:mm' (see ubp.quantize()), kept
+    by published field name in `precisions`.
+    """
+    def __init__(self, obj_type, config):
+        self.type_name = obj_type.__name__
+        self.missing = set()
+        self.fields = []
+        self.precisions = {}
+        for field in config:
+            field, _, policy = field.partition(':')
+            policy = ubp.check_precision(policy) if policy else None
+            attr = getattr(obj_type, field, None)
+            if inspect.isfunction(attr):
+                name, function, getter = re.sub(f"^{re.escape('get_')}", "", field), attr, None
+            elif callable(attr):
+                name, function, getter = re.sub(f"^{re.escape('get_')}", "", field), None, operator.methodcaller(field)
+            else:
+                name, function, getter = field, None, operator.attrgetter(field)
+            self.fields.append((name, function, getter, policy))
+            if policy is not None:
+                self.precisions[name] = policy
+
+    def read(self, obj):
+        serialized_obj = {}
+        for name, function, getter, policy in self.fields:
+            if function is not None:
+                value = function(obj)
+            else:
+                try:
+                    value = getter(obj)
+                except AttributeError:
+                    if name not in self.missing:
+                        self.missing.add(name)
+                        print(f"UnityBridge: '{name}' is missing on {self.type_name}, field not sent.")
+                    continue
+            serialized_obj[name] = value if policy is None else ubp.quantize(value, policy)
+        return serialized_obj
+
+
+def _published_name(spec):
+    """ Name a config field is published with: without precision policy nor 'get_' prefix. """
+    return re.sub(f"^{re.escape('get_')}", "", spec.partition(':')[0])
+
+
+def _freeze(value):
+    """ A private copy of the mutable containers of a serialized value. """
+    if isinstance(value, np.ndarray):
+        value = value.copy()
+        value.flags.writeable = False
+        return value
+    if isinstance(value, dict):
+        return {key: _freeze(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_freeze(item) for item in value]
+    return value
+
+
+def _exact(value):
+    """ A value as a delta client holds it after decoding the JSON: floats as float64 arrays. """
+    array = ubp.float_array(value)
+    return value if array is None else array
+
+
+def _equal(a, b):
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return np.array_equal(a, b)
+    return a == b
+
+
+class _DeltaState:
+    """ Delta encoder of one client.
+
+    Deltas are computed against the last frame the client acknowledged, using the
+    values the client reconstructed from it (base + steps * quantum), so the
+    quantization error of float fields does not accumulate from frame to frame.
+    """
+    def __init__(self, keyframe_interval, quantum):
+        self.keyframe_interval = keyframe_interval
+        self.quantum = quantum
+        # seq -> flattened frame as reconstructed by the client, for the frames not acknowledged yet
+        self.sent = OrderedDict()
+        self.base_seq = None
+        self.base = None
+        self.since_keyframe = 0
+
+    def ack(self, seq):
+        state = self.sent.get(seq)
+        if state is None:
+            return
+        self.base_seq = seq
+        self.base = state
+        while self.sent:
+            oldest = next(iter(self.sent))
+            if oldest > seq:
+                break
+            del self.sent[oldest]
+
+    def encode(self, snapshot, view=None):
+        """ The delta payload for the snapshot, None when a keyframe has to be sent instead. """
+        flat = ubp.flatten(snapshot.view(view))
+        if self.base is None or self.since_keyframe >= self.keyframe_interval:
+            self.since_keyframe = 0
+            self._remember(snapshot.seq, {item: _exact(value) for item, value in flat.items()})
+            return None
+        self.since_keyframe += 1
+
+        changes = {"base": self.base_seq, "set": [], "add": [], "remove": []}
+        state = {}
+        for item, value in flat.items():
+            base = self.base.get(item, _MISSING)
+            array = ubp.float_array(value)
+            if array is not None and isinstance(base, np.ndarray) and base.shape == array.shape:
+                steps = np.rint((array - base) / self.quantum).astype(np.int64)
+                if steps.any():
+                    state[item] = base + steps * self.quantum
+                    changes["add"].append([item[0], item[1], steps.tolist()])
+                else:
+                    state[item] = base
+                continue
+            state[item] = _exact(value)
+            if base is _MISSING or not _equal(base, state[item]):
+                changes["set"].append([item[0], item[1], value])
+        changes["remove"] = [list(item) for item in self.base if item not in flat]
+        self._remember(snapshot.seq, state)
+        return ubp.encode_json(changes)
+
+    def _remember(self, seq, state):
+        self.sent[seq] = state
+        if len(self.sent) > _DELTA_HISTORY:
+            self.sent.popitem(last=False)
+
+
+class FrameSnapshot:
+    """ One frame given to UnityBridge.send(), never modified once published.
+
+    Each payload encoding and each framed message is built the first time a
+    client needs it and the same bytes are then sent to every client.
+    """
+    def __init__(self, seq, timestamp, data, serial=None, camera_seq=0, precisions=None, capture_time=None,
+                 velocities=None):
+        self.seq = seq
+        # Publish time, and time the camera took the frame when known, in microseconds
+        self.timestamp = timestamp
+        self.capture_time = capture_time
+        self.data = data
+        # {(key, field): policy} of the quantized fields, for the binary encoding
+        self.precisions = precisions
+        # {(key, field): velocity per second} of the hands, when prediction is enabled
+        self.velocities = velocities
+        # Camera that produced the frame, and number of frames published for it so far
+        self.serial = serial
+        self.camera_seq = camera_seq
+        self._messages = {}
+        self._views = {}
+        self._lock = threading.Lock()
+        # First error raised while encoding the frame, it is then sent to no client
+        self.encoding_error = None
+
+    def view(self, view):
+        """ The data for a client subscription (fields, max_hands, horizon), all of it for None.
+
+        With a horizon (seconds), the hands with a velocity are extrapolated that
+        far past the capture time.
+        """
+        if view is None:
+            return self.data
+        with self._lock:
+            data = self._views.get(view)
+            if data is None:
+                fields, max_hands, horizon = view
+                data = {}
+                for key, value in self.data.items():
+                    if key.startswith(_HAND_PREFIX) and isinstance(value, dict):
+                        if max_hands is not None and key[len(_HAND_PREFIX):].isdigit() \
+                                and int(key[len(_HAND_PREFIX):]) >= max_hands:
+                            continue
+                        if fields is not None:
+                            value = {field: item for field, item in value.items() if field in fields}
+                        if horizon and self.velocities:
+                            value = self._predict(key, value, horizon)
+                    data[key] = value
+                self._views[view] = data
+        return data
+
+    def _predict(self, key, value, horizon):
+        predicted = dict(value)
+        for field, item in value.items():
+            velocity = self.velocities.get((key, field))
+            if velocity is None:
+                continue
+            item = ubp.float_array(item) + velocity * horizon
+            policy = self.precisions.get((key, field)) if self.precisions else None
+            predicted[field] = item if policy is None else ubp.quantize(item, policy)
+        return predicted
+
+    def payload(self, encoding, view=None):
+        key = (encoding, view)
+        payload = self._messages.get(key)
+        if payload is None:
+            data = self.view(view)
+            with self._lock:
+                payload = self._messages.get(key)
+                if payload is None:
+                    if encoding == ubp.ENCODING_BINARY:
+                        payload = ubp.encode_binary(data, self.precisions)
+                    else:
+                        payload = ubp.encode_json(data)
+                    self._messages[key] = payload
+        return payload
+
+    def message(self, framing, encoding, view=None):
+        key = (framing, encoding, view)
+        message = self._messages.get(key)
+        if message is None:
+            flags = ubp.FLAG_BINARY if encoding == ubp.ENCODING_BINARY else 0
+            message = ubp.frame_message(framing, ubp.MSG_DATA, self.seq, self.payload(encoding, view), self.timestamp, flags)
+            with self._lock:
+                message = self._messages.setdefault(key, message)
+        return message
+
 
 class UnityBridge:
-    def __init__(self, address):
+    def __init__(self, address, poll_interval=0.05, default_framing=ubp.FRAMING_SENTINEL,
+                 delta_keyframe_interval=30, delta_quantum=0.0005, max_in_flight=1, max_unacked=8,
+                 compression_level=1, compression_threshold=256):
         self.address = address
         self.socket = None
         self.running = False
+        # Last EncodedImage, see enable_images()
         self.image = None
-        self.names = None
-        self.objects = None
-        self.configs = None
-        self.serialNumber = None
-        self.data = None
+        self.image_encoder = None
+        # ShmRingWriter, see enable_shared_memory()
+        self.shm_writer = None
+        self._shm_lock = threading.Lock()
+        # FrameRecorder, see enable_recording()
+        self.recorder = None
+        # _Predictor, see enable_prediction()
+        self.predictor = None
         self.count = 0
+        # Incremented by every send(), carried in the frame header
+        self.frame_seq = 0
+        # Last published FrameSnapshot, replaced as a whole under _frame_cond,
+        # and last one of each camera, by serial number
+        self.snapshot = None
+        self.snapshots = {}
+        self._frame_cond = threading.Condition()
+        # Minimum delay between two answers sent to the same client
+        self.poll_interval = poll_interval
+        # Framing of the clients that don't send HELO
+        if default_framing not in ubp.FRAMINGS:
+            raise ValueError(f"Unknown framing: {default_framing}")
+        self.default_framing = default_framing
+        # Delta mode: a full frame at least every delta_keyframe_interval frames,
+        # float fields sent as steps of delta_quantum (meters for the landmarks)
+        self.delta_keyframe_interval = delta_keyframe_interval
+        self.delta_quantum = delta_quantum
+        # Push mode backpressure: a client with max_in_flight frames still in its send
+        # queue, or max_unacked frames not acknowledged (clients sending ACKN), skips
+        # the new frames and gets the newest one as soon as it catches up.
+        self.max_in_flight = max_in_flight
+        self.max_unacked = max_unacked
+        # Compression requested in HELO: zlib level, and payload size below which frames are sent raw
+        self.compression_level = compression_level
+        self.compression_threshold = compression_threshold
+        self.selector = None
+        self.clients = {}
+        self._thread = None
+        # Datagram socket of the UDP mode, TCP stays the control channel
+        self.udp_socket = None
+        # send() wakes the event loop through this socket pair to push new frames
+        self._wake_r = None
+        self._wake_w = None
+        self._frame_pending = False
+        # Compiled accessors, keyed on (object type, config tuple)
+        self._plans = {}
+        # (names, number of objects, configs) layouts that passed the checks of _serialize_objects
+        self._checked_layouts = set()
+        # Startup stages reached (ubp.READY_STAGES), {stage: timestamp}, see set_ready()
+        self.ready = {}
+        self.status_version = 0
+        # Union of the client subscriptions as (hand fields, max hands), None parts for
+        # everything, replaced as a whole by the event loop, see send_hands()
+        self.subscription = (None, None)
+        # (hand_fields, subscribed fields) -> config of the hands, see send_hands()
+        self._hand_configs = {}
+        # Stage timings and counters, see enable_metrics()
+        self.metrics = Metrics()
+        self.metrics.add_collector(self._client_metrics)
 
     def start(self):
         """ Start the networking thread. """
         self.running = True
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self.socket.bind(self.address) 
+        self.socket.bind(self.address)
         print("Server Started!")
         self.socket.listen(10)
-        thread.start_new_thread(self._run, ())
+        self.socket.setblocking(False)
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.bind((self.address[0], 0))
+        self.udp_socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def enable_images(self, scale=0.5, quality=80, skip=1, workers=2):
+        """ Also publish the frames given to send() as JPEG, encoded by a pool of worker threads.
+
+        scale: downscale factor applied before encoding
+        quality: JPEG quality (0-100)
+        skip: only one frame out of `skip` is encoded
+        """
+        self.image_encoder = ImageEncoder(self._publish_image, scale, quality, skip, workers)
+
+    def enable_shared_memory(self, path=None, slots=4, max_hands=2, image_shape=None):
+        """ Also publish every frame to a memory-mapped ring buffer for readers on the same host.
+
+        path: ring buffer file, by default unity_bridge_<port>.shm in the temp directory
+        image_shape: (height, width, channels) of the frame pixels kept per slot, None for no image
+        See unity_bridge_shm for the layout and ShmRingReader.
+        """
+        if path is None:
+            path = unity_bridge_shm.default_path(self.address[1])
+        self.shm_writer = unity_bridge_shm.ShmRingWriter(path, slots, max_hands, image_shape)
+        self._update_subscription()
+        print("Shared memory ring buffer:", path)
+
+    def enable_recording(self, path):
+        """ Append every published frame to a log file, replayed by replay_unity_bridge.py.
+
+        Raises ValueError when the file exists and is not a recording of this version.
+        """
+        self.recorder = FrameRecorder(path)
+        self._update_subscription()
+        print("Recording to", path)
+
+    def enable_prediction(self, smoothing=0.5, max_gap=0.2):
+        """ Track the velocity of the hands, so clients can ask for predicted poses with HELO "predict_ms".
+
+        smoothing: weight of the last frame in the smoothed velocity (0-1)
+        max_gap: seconds between two frames of a hand above which its velocity is reset
+        """
+        self.predictor = _Predictor(smoothing, max_gap)
+        self._update_subscription()
+
+    def enable_metrics(self, port, host='127.0.0.1'):
+        """ Serve the stage timings (self.metrics, Prometheus text format) on http://host:port/metrics. """
+        self.metrics.serve(port, host)
+
+    def send(self, names, objects, configs, serialNumber, frame=None, capture_time=None):
+        # capture_time: time.time() the camera took the frame, None if unknown.
+        # The back snapshot is built completely, with its own copy of the values, before
+        # it replaces the front one: readers never see half of a frame, and the tracker
+        # can keep modifying its objects while clients encode the published frame.
+        # Serialized once here, every client then shares the encoded bytes of the snapshot.
+        with self.metrics.time('serialize'):
+            data = _freeze(self._serialize_objects(names, objects, configs, serialNumber))
+            precisions = self._precisions(names, objects, configs)
+        self.publish(data, serialNumber, frame, precisions, capture_time)
+
+    def send_hands(self, hands, hand_fields, serialNumber, frame=None, names=(), objects=(), configs=(),
+                   capture_time=None):
+        """ Send the hands as hand_0, hand_1... with only the fields the clients subscribed to.
+
+        hand_fields: config of every field the tracker provides, e.g. ['label', 'xyz:mm',
+        'get_rotated_world_landmarks']. Fields no client asked for in HELO ("fields",
+        "max_hands") are not read, so their getters are not called.
+        names, objects, configs: other objects, sent as with send().
+        capture_time: time.time() the camera took the frame, None if unknown.
+        """
+        fields, max_hands = self.subscription
+        if max_hands is not None:
+            hands = hands[:max_hands]
+        config = self._hand_config(tuple(hand_fields), fields)
+        self.send([f"{_HAND_PREFIX}{i}" for i in range(len(hands))] + list(names),
+                  list(hands) + list(objects),
+                  [config] * len(hands) + list(configs),
+                  serialNumber, frame, capture_time)
 
-    def send(self, names, objects, configs, serialNumber):
-        self.names = names
-        self.objects = objects
-        self.configs = configs
-        self.serialNumber = serialNumber
+    def _hand_config(self, hand_fields, fields):
+        key = (hand_fields, fields)
+        config = self._hand_configs.get(key)
+        if config is None:
+            config = self._hand_configs[key] = tuple(
+                spec for spec in hand_fields if fields is None or _published_name(spec) in fields)
+        return config
+
+    def _update_subscription(self):
+        """ Union of the fields and hands subscribed to by the connected clients. """
+        fields, max_hands = set(), 0
+        if not self.clients or self.shm_writer is not None or self.recorder is not None:
+            # Every field for the other consumers, and for the first answer to a new client
+            fields = max_hands = None
+        for client in self.clients.values():
+            client_fields, client_max_hands, _ = client.view or (None, None, None)
+            fields = None if fields is None or client_fields is None else fields | client_fields
+            max_hands = None if max_hands is None or client_max_hands is None else max(max_hands, client_max_hands)
+        if fields is not None and self.predictor is not None:
+            # The predictor tells the hands apart by label, FrameSnapshot.view() strips it from the other clients
+            fields.add('label')
+        self.subscription = (None if fields is None else frozenset(fields), max_hands)
+
+    def publish(self, data, serialNumber, frame=None, precisions=None, capture_time=None):
+        """ Publish an already serialized frame, e.g. a recorded one. The values of data are not copied.
+
+        precisions: {(key, field): policy} of the fields already quantized, see _SerializationPlan
+        capture_time: time.time() the camera took the frame, None if unknown
+        Frames are encoded by the event loop: one that cannot be (e.g. a set value)
+        is logged and counted in frames_unencodable_total, not sent.
+        """
+        if ubp.READY_FIRST_INFERENCE not in self.ready:
+            self.set_ready(ubp.READY_FIRST_INFERENCE)
+        timestamp = ubp.timestamp_us()
+        data = dict(data, publishTime=timestamp)
+        if capture_time is not None:
+            data["captureTime"] = ubp.timestamp_us(capture_time)
+        else:
+            data.pop("captureTime", None)
+        velocities = None
+        if self.predictor is not None:
+            velocities = self.predictor.update(serialNumber, data, data.get("captureTime", timestamp) / 1000000)
+        with self._frame_cond:
+            self.frame_seq += 1
+            previous = self.snapshots.get(serialNumber)
+            camera_seq = previous.camera_seq + 1 if previous is not None else 1
+            self.snapshot = snapshot = FrameSnapshot(self.frame_seq, timestamp, data, serialNumber, camera_seq,
+                                                     precisions, data.get("captureTime"), velocities)
+            self.snapshots[serialNumber] = snapshot
+            self._frame_cond.notify_all()
+        self.metrics.inc('frames_published_total')
+        if self.recorder is not None:
+            self.recorder.record(snapshot)
+        if self.shm_writer is not None:
+            # Several trackers can share the bridge (hand_tracking_hub.py)
+            with self._shm_lock, self.metrics.time('shm_write'):
+                self.shm_writer.write_snapshot(snapshot, frame)
+        if frame is not None and self.image_encoder is not None:
+            self.image_encoder.submit(frame, snapshot.seq, snapshot.timestamp)
+        self._wake()
+
+    def set_ready(self, stage):
+        """ Record a startup stage, report it to the launcher (stdout) and to the header clients (MSG_STATUS). """
+        with self._frame_cond:
+            if stage in self.ready:
+                return
+            self.ready[stage] = ubp.timestamp_us()
+            self.status_version += 1
+            self._frame_cond.notify_all()
+        print("READY", stage, flush=True)
+        self._wake()
+
+    def wait_ready(self, stage=ubp.READY_FIRST_INFERENCE, timeout=None):
+        """ Block until the startup stage is reached, False on timeout. """
+        with self._frame_cond:
+            return self._frame_cond.wait_for(lambda: stage in self.ready, timeout)
+
+    def status(self):
+        return {"stages": dict(self.ready), "ready": ubp.READY_FIRST_INFERENCE in self.ready}
+
+    def _publish_image(self, image):
+        with self._frame_cond:
+            if self.image is not None and self.image.seq >= image.seq:
+                return
+            self.image = image
+        self._wake()
+
+    def client_stats(self):
+        """ Delivery counters of every connected client. """
+        return [{
+            "address": client.addr,
+            "frames_delivered": client.frames_delivered,
+            "frames_dropped": client.frames_dropped,
+            "frames_in_flight": client.frames_in_flight,
+            "frames_unacked": len(client.unacked) if client.acknowledging else None,
+            "bytes_pending": client.out_bytes,
+            "compression_ratio": client.compressed_in / client.compressed_out if client.compressed_out else None,
+            "delivery_rate": client.delivery_rate.rate,
+            "ack_rate": client.ack_rate.rate,
+        } for client in list(self.clients.values())]
+
+    def _client_metrics(self):
+        stats = self.client_stats()
+        return [
+            ("clients", "gauge", "Connected clients", [({}, len(stats))]),
+            ("client_frames_delivered_total", "counter", "Frames completely written to the client socket",
+             [({"client": "%s:%d" % stat["address"]}, stat["frames_delivered"]) for stat in stats]),
+            ("client_frames_dropped_total", "counter", "Frames skipped because the client was behind",
+             [({"client": "%s:%d" % stat["address"]}, stat["frames_dropped"]) for stat in stats]),
+            ("client_bytes_pending", "gauge", "Bytes queued for the client",
+             [({"client": "%s:%d" % stat["address"]}, stat["bytes_pending"]) for stat in stats]),
+        ]
+
+    def wait_for_frame(self, after_seq=0, timeout=None):
+        """ The first snapshot with a sequence number above after_seq, None on timeout. """
+        with self._frame_cond:
+            if self._frame_cond.wait_for(lambda: self.snapshot is not None and self.snapshot.seq > after_seq, timeout):
+                return self.snapshot
+        return None
 
     def close(self):
-        """ Close the socket connection. """
+        """ Stop the networking thread and close all the sockets. """
         self.running = False
-        if self.socket:
-            self.socket.close()
+        if self.image_encoder is not None:
+            self.image_encoder.close()
+        if self.shm_writer is not None:
+            self.shm_writer.close()
+            self.shm_writer = None
+        self.metrics.close()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._wake()
+            self._thread.join()
+            self._thread = None
+
+    def _wake(self):
+        """ Interrupt select() so the event loop sees a new frame or close(). """
+        if self._wake_w is None or self._frame_pending:
+            return
+        self._frame_pending = True
+        try:
+            self._wake_w.send(b'\0')
+        except OSError:
+            pass
+
+    def missing_fields(self):
+        """ Fields listed in a config but missing on the objects, as {type name: [fields]}. """
+        missing = {}
+        for plan in self._plans.values():
+            if plan.missing:
+                missing.setdefault(plan.type_name, set()).update(plan.missing)
+        return {type_name: sorted(fields) for type_name, fields in missing.items()}
+
+    def _plan(self, obj, config):
+        key = (type(obj), config)
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = self._plans[key] = _SerializationPlan(type(obj), config)
+        return plan
 
     def _serialize_objects(self, key_names, objects, configs, serialNumber):
-        # Ensure that key_names, objects, and configs have the same length
-        if not (len(key_names) == len(objects) == len(configs)):
-            raise ValueError("Length of key_names, objects, and configs must be the same.")
+        configs = tuple(map(tuple, configs))
+        layout = (tuple(key_names), len(objects), configs)
+        if layout not in self._checked_layouts:
+            # Ensure that key_names, objects, and configs have the same length
+            if not (len(key_names) == len(objects) == len(configs)):
+                raise ValueError("Length of key_names, objects, and configs must be the same.")
 
-        if len(key_names) != len(set(key_names)):
-            raise ValueError("Key names must be unique.")
+            if len(key_names) != len(set(key_names)):
+                raise ValueError("Key names must be unique.")
+            self._checked_layouts.add(layout)
 
-        # Initialize a dictionary to store the serialized data
-        serialized_data = {}#{key: [] for key in key_names}
+        # numpy values are kept as they are, the encoder of each client converts them
+        serialized_data = {key_name: self._plan(obj, config).read(obj)
+                           for obj, config, key_name in zip(objects, configs, key_names)}
+        serialized_data["serialNumber"] = serialNumber
+        return serialized_data
 
+    def _precisions(self, key_names, objects, configs):
+        """ {(key name, field): policy} of the fields given a precision policy in the configs. """
+        precisions = {}
         for obj, config, key_name in zip(objects, configs, key_names):
-            serialized_obj = {}
-            for field in config:
-                if hasattr(obj, field):
-                    attr = getattr(obj, field)
-                    if callable(attr):
-                        value = attr()
-                        field = re.sub(f"^{re.escape('get_')}", "", field)
+            for field, policy in self._plan(obj, tuple(config)).precisions.items():
+                precisions[(key_name, field)] = policy
+        return precisions or None
+
+    def _run(self):
+        """ The event loop serving every client from the networking thread. """
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, self._wake_r)
+        print("Listening...")
+        self.set_ready(ubp.READY_LISTENING)
+        try:
+            while self.running:
+                for key, mask in self.selector.select(self._select_timeout()):
+                    if key.data is None:
+                        self._accept()
+                    elif key.data is self._wake_r:
+                        self._push_frame()
                     else:
-                        value = attr
-                else:
-                    continue
-                # Check if the value is a numpy.ndarray and convert it to a list
-                if isinstance(value, np.ndarray):
-                    value = value.tolist()
-                # Add other type checks and conversions as necessary
-                serialized_obj[field] = value
-            serialized_data[key_name] = serialized_obj
-        serialized_data["serialNumber"] = serialNumber
-        return serialized_data
+                        self._guarded(key.data, self._service, key.data, mask)
+                self._answer_requests()
+        finally:
+            for client in list(self.clients.values()):
+                self._disconnect(client)
+            self.selector.unregister(self.socket)
+            self.selector.unregister(self._wake_r)
+            self.selector.close()
+            self.socket.close()
+            self.udp_socket.close()
+            self._wake_r.close()
+            self._wake_w.close()
+            self._wake_w = None
 
+    def _guarded(self, client, function, *args):
+        """ Serve one client: an unexpected error disconnects that client only, not the event loop. """
+        try:
+            function(*args)
+        except Exception as e:
+            print(f"Error serving {client.addr}, disconnecting it: {e!r}")
+            self.metrics.inc('client_errors_total')
+            self._disconnect(client)
 
-    def client(self, conn, addr):
-        while True:
+    def _select_timeout(self):
+        """ Wait no longer than the next throttled answer is due.
 
-            # Wait for DATA command
+        Requests no frame can answer yet do not count: publish() wakes the loop
+        when their frame arrives.
+        """
+        timeout = _SELECT_TIMEOUT
+        if self.snapshot is None:
+            return timeout
+        now = time.monotonic()
+        for client in self.clients.values():
+            if client.pending_requests and self._pending(client, 0):
+                timeout = min(timeout, max(0.0, client.next_send_time - now))
+        return timeout
 
+    def _accept(self):
+        try:
+            conn, addr = self.socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        conn.setblocking(False)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = _ClientConnection(conn, addr)
+        client.framing = self.default_framing
+        self.clients[conn.fileno()] = client
+        self._update_subscription()
+        self.selector.register(conn, selectors.EVENT_READ, client)
+        print('Connected with ', addr)
+
+    def _service(self, client, mask):
+        if mask & selectors.EVENT_READ:
             try:
-                data = bytearray()
-                while len(data) < 4:
-                    packet = conn.recv(4)
-                    if not packet:
-                        break
-                    if len(packet) == 0:
-                        break
-
-                    data.extend(packet)
-
-            except:
-                self._error(conn, addr)
-                break
+                packet = client.conn.recv(_RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                packet = None
+            except OSError:
+                packet = b''
+            if packet == b'':
+                self._disconnect(client)
+                return
+            if packet:
+                client.recv_time = ubp.timestamp_us()
+                client.inbuf.extend(packet)
+                self._parse_commands(client)
+        if mask & selectors.EVENT_WRITE:
+            self._flush(client)
 
-            if not data.decode('utf-8'):
+    def _parse_commands(self, client):
+        while len(client.inbuf) >= 4:
+            command = bytes(client.inbuf[:4])
+            if command == CMD_HELLO:
+                payload = self._command_payload(client)
+                if payload is None:
+                    break
+                self._hello(client, payload)
                 continue
+            if command in (CMD_WAIT, CMD_ACK):
+                seq = self._command_seq(client)
+                if seq is None:
+                    break
+                if command == CMD_WAIT:
+                    client.wait_seq = seq
+                    self._answer_wait(client)
+                else:
+                    self._ack(client, seq)
+                continue
+            if command == CMD_TIME:
+                if len(client.inbuf) < 4 + ubp.COMMAND_TIME.size:
+                    break
+                client_time, = ubp.COMMAND_TIME.unpack_from(client.inbuf, 4)
+                del client.inbuf[:4 + ubp.COMMAND_TIME.size]
+                self._answer_time(client, client_time)
+                continue
+            del client.inbuf[:4]
+            if command == CMD_SUBSCRIBE:
+                client.streaming = True
+                client.pending_requests = 0
+                self._catch_up(client)
+            elif not client.streaming:
+                client.pending_requests += 1
 
-            # Received DATA command
+    def _answer_time(self, client, client_time):
+        if client.framing != ubp.FRAMING_HEADER:
+            # A sentinel client would read the answer as a frame
+            return
+        answer = {"client": client_time, "receive": client.recv_time, "send": ubp.timestamp_us()}
+        self._queue(client, ubp.frame_message(ubp.FRAMING_HEADER, ubp.MSG_TIME, 0, json.dumps(answer).encode('utf-8')))
 
-            self.data = self._serialize_objects(self.names, self.objects,self.configs, self.serialNumber)
-            self._send_data(conn, self.data)
+    def _ack(self, client, seq):
+        client.acknowledging = True
+        client.ack_rate.tick(time.monotonic())
+        while client.unacked and client.unacked[0] <= seq:
+            client.unacked.popleft()
+        if client.delta is not None:
+            client.delta.ack(seq)
+        self._catch_up(client)
 
-            time.sleep(0.05) 
+    def _can_push(self, client):
+        """ False while a push-mode client is behind, its new frames are then skipped. """
+        if client.frames_in_flight >= self.max_in_flight:
+            return False
+        return not (client.acknowledging and len(client.unacked) >= self.max_unacked)
 
-        conn.close()
-        print('Disconnected ', addr)
-        
-    def createConnection(self):
-        """ The main loop for the networking thread. """
-        while True:
-            print("Listening...")
-            try:
-                conn, addr = self.socket.accept()
-                print('Connected with ', addr)
-                thread.start_new_thread(self.client, (conn, addr))
-                time.sleep(1000)
-            except:
-                break    
-
-    def _error(self, conn, addr):
-        print("Client disconnected. Retry...")
+    def _catch_up(self, client):
+        """ Send the newest frame to a push-mode client that skipped frames, once it can take it. """
+        if not client.streaming or not self._can_push(client):
+            return
+        pending = self._pending(client, client.sent_seq)
+        if pending:
+            self._send_data(client, pending[0])
+
+    def _pending(self, client, after_seq):
+        """ Last frame of each camera of the client newer than after_seq, oldest first.
+
+        Only the last frame of a camera is kept, so a frame not sent yet is always
+        newer than the last one sent, and sending them oldest first loses none.
+        """
+        pending = [snapshot for serial, snapshot in list(self.snapshots.items())
+                   if snapshot.seq > after_seq and (client.cameras is None or serial in client.cameras)]
+        pending.sort(key=operator.attrgetter('seq'))
+        return pending
+
+    def _command_seq(self, client):
+        """ Consume a command followed by a sequence number, None until it is complete. """
+        if len(client.inbuf) < 4 + ubp.COMMAND_SEQ.size:
+            return None
+        seq, = ubp.COMMAND_SEQ.unpack_from(client.inbuf, 4)
+        del client.inbuf[:4 + ubp.COMMAND_SEQ.size]
+        return seq
+
+    def _command_payload(self, client):
+        """ Consume a command with a length-prefixed payload, None until it is complete. """
+        header_size = 4 + ubp.COMMAND_LENGTH.size
+        if len(client.inbuf) < header_size:
+            return None
+        length, = ubp.COMMAND_LENGTH.unpack_from(client.inbuf, 4)
+        if len(client.inbuf) < header_size + length:
+            return None
+        payload = bytes(client.inbuf[header_size:header_size + length])
+        del client.inbuf[:header_size + length]
+        return payload
+
+    def _hello(self, client, payload):
+        """ Apply the options requested by the client and answer with the accepted ones. """
+        reply = {}
         try:
-            self.createConnection()
-        except:
-            print(addr, "Disconnected.")
+            options = json.loads(payload.decode('utf-8'))
+        except ValueError as e:
+            options = {}
+            reply["error"] = f"Invalid HELO options: {e}"
+        if not isinstance(options, dict):
+            options = {}
+            reply["error"] = "HELO options must be a JSON object"
+        framing = options.get("framing", client.framing)
+        if framing in ubp.FRAMINGS:
+            client.framing = framing
+        else:
+            reply["error"] = f"Unknown framing: {framing}"
+        encoding = options.get("encoding", client.encoding)
+        if encoding not in ubp.ENCODINGS:
+            reply["error"] = f"Unknown encoding: {encoding}"
+        elif encoding == ubp.ENCODING_BINARY and client.framing != ubp.FRAMING_HEADER:
+            reply["error"] = "The binary encoding needs the header framing"
+        else:
+            client.encoding = encoding
+        if client.framing != ubp.FRAMING_HEADER:
+            client.encoding = ubp.ENCODING_JSON
+        if options.get("delta"):
+            if client.framing != ubp.FRAMING_HEADER or client.encoding != ubp.ENCODING_JSON:
+                reply["error"] = "The delta mode needs the header framing and the JSON encoding"
+            else:
+                keyframe_interval = options.get("keyframe_interval", self.delta_keyframe_interval)
+                if not isinstance(keyframe_interval, int) or isinstance(keyframe_interval, bool) or keyframe_interval < 1:
+                    reply["error"] = "keyframe_interval must be a positive number of frames"
+                else:
+                    client.delta = _DeltaState(keyframe_interval, self.delta_quantum)
+        elif "delta" in options:
+            client.delta = None
+        if "images" in options:
+            if client.framing == ubp.FRAMING_HEADER:
+                client.images = bool(options["images"])
+            else:
+                reply["error"] = "Image messages need the header framing, sentinel clients get images after the JSON"
+        reply["version"] = ubp.PROTOCOL_VERSION
+        reply["framing"] = client.framing
+        reply["encoding"] = client.encoding
+        if client.delta is not None:
+            reply["delta"] = True
+            reply["keyframe_interval"] = client.delta.keyframe_interval
+            reply["quantum"] = client.delta.quantum
+        reply["images"] = client.images and self.image_encoder is not None
+        if "cameras" in options:
+            cameras = options["cameras"]
+            if cameras is None or (isinstance(cameras, list) and all(isinstance(serial, str) for serial in cameras)):
+                client.cameras = None if cameras is None else set(cameras)
+            else:
+                reply["error"] = "cameras must be a list of serial numbers, or null for all"
+        if options.get("compression"):
+            if options["compression"] != ubp.COMPRESSION_ZLIB:
+                reply["error"] = f"Unknown compression: {options['compression']}"
+            elif client.framing != ubp.FRAMING_HEADER:
+                reply["error"] = "Compression needs the header framing"
+            elif client.compressor is None:
+                level = options.get("compression_level", self.compression_level)
+                if not isinstance(level, int) or not 0 <= level <= 9:
+                    level = self.compression_level
+                client.compressor = zlib.compressobj(level)
+        if client.compressor is not None:
+            reply["compression"] = ubp.COMPRESSION_ZLIB
+            reply["compression_threshold"] = self.compression_threshold
+        if "fields" in options or "max_hands" in options or "predict_ms" in options:
+            fields, max_hands, horizon = client.view or (None, None, None)
+            fields = options.get("fields", None if fields is None else sorted(fields))
+            max_hands = options.get("max_hands", max_hands)
+            predict_ms = options.get("predict_ms", None if horizon is None else round(horizon * 1000, 3))
+            if fields is not None and not (isinstance(fields, list) and all(isinstance(field, str) for field in fields)):
+                reply["error"] = "fields must be a list of field names, or null for all"
+            elif max_hands is not None and not (isinstance(max_hands, int) and max_hands >= 0):
+                reply["error"] = "max_hands must be a positive number, or null for all"
+            elif predict_ms is not None and not (isinstance(predict_ms, (int, float)) and 0 <= predict_ms <= 1000):
+                reply["error"] = "predict_ms must be a number of milliseconds (0-1000), or null for none"
+            elif predict_ms and self.predictor is None:
+                reply["error"] = "Prediction is not enabled on the bridge"
+            else:
+                view = (None if fields is None else frozenset(fields), max_hands, predict_ms / 1000 if predict_ms else None)
+                client.view = None if view == (None, None, None) else view
+                self._update_subscription()
+        if client.view is not None:
+            reply["fields"] = None if client.view[0] is None else sorted(client.view[0])
+            reply["max_hands"] = client.view[1]
+            reply["predict_ms"] = None if client.view[2] is None else round(client.view[2] * 1000, 3)
+        reply["status"] = self.status()
+        client.status_version = self.status_version
+        # Serial numbers of the cameras that published a frame so far, and the subscribed ones
+        reply["cameras"] = sorted(str(serial) for serial in list(self.snapshots))
+        reply["subscribed"] = None if client.cameras is None else sorted(client.cameras)
+        if self.shm_writer is not None:
+            reply["shared_memory"] = self.shm_writer.path
+        if "udp_port" in options:
+            port = options["udp_port"]
+            if not port:
+                client.udp_addr = None
+            elif not isinstance(port, int) or isinstance(port, bool) or not 1 <= port <= 65535:
+                reply["error"] = "udp_port must be a port number (1-65535), or null for none"
+            else:
+                client.udp_addr = (client.addr[0], port)
+        if client.udp_addr is not None and client.encoding != ubp.ENCODING_BINARY:
+            # A JSON frame of two hands is about twice UDP_MAX_DATAGRAM, it would never be sent
+            client.udp_addr = None
+            reply["error"] = "UDP datagrams need the binary encoding"
+        if client.udp_addr is not None:
+            reply["udp_port"] = client.udp_addr[1]
+            reply["udp_max_datagram"] = ubp.UDP_MAX_DATAGRAM
+        self._queue(client, ubp.frame_message(client.framing, ubp.MSG_HELLO, 0, json.dumps(reply).encode('utf-8')))
 
-    def _run(self):
-        time.sleep(5)
-        self.createConnection()
+    def _push_frame(self):
+        """ Stream the last frame given to send() and the last image to every subscribed client. """
+        try:
+            while self._wake_r.recv(_RECV_SIZE):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        self._frame_pending = False
+        snapshot = self.snapshot
+        image = self.image
+        clients = list(self.clients.values())
+        status_version = self.status_version
+        status = None
+        if any(client.framing == ubp.FRAMING_HEADER and client.status_version < status_version for client in clients):
+            status = ubp.frame_message(ubp.FRAMING_HEADER, ubp.MSG_STATUS, 0, json.dumps(self.status()).encode('utf-8'))
+        for client in clients:
+            self._guarded(client, self._push_to_client, client, snapshot, image, status, status_version)
+
+    def _push_to_client(self, client, snapshot, image, status, status_version):
+        if client.framing == ubp.FRAMING_HEADER and client.status_version < status_version:
+            client.status_version = status_version
+            self._queue(client, status)
+        if image is not None and client.images and image.seq > client.image_seq:
+            client.image_seq = image.seq
+            self._queue(client, ubp.pack_header(ubp.MSG_IMAGE, image.seq, len(image.data), image.timestamp), image.data)
+        if client.udp_addr is not None and snapshot is not None and snapshot.seq > client.udp_seq:
+            for pending in self._pending(client, client.udp_seq):
+                self._send_datagram(client, pending)
+        if snapshot is None or snapshot.seq <= client.sent_seq:
+            return
+        if client.streaming:
+            self._catch_up(client)
+        elif client.wait_seq is not None:
+            self._answer_wait(client)
+
+    def _send_datagram(self, client, snapshot):
+        """ UDP mode: the frame in one datagram. Late or lost datagrams are not resent. """
+        client.udp_seq = snapshot.seq
+        try:
+            message = snapshot.message(ubp.FRAMING_HEADER, client.encoding, client.view)
+        except _ENCODING_ERRORS as e:
+            self._encoding_failed(snapshot, e)
+            return
+        if len(message) > ubp.UDP_MAX_DATAGRAM:
+            if not client.udp_oversize:
+                print(f"Frame of {len(message)} bytes too large for one datagram, not sent over UDP to {client.addr}."
+                      " Use the binary encoding.")
+            client.udp_oversize += 1
+            return
+        try:
+            self.udp_socket.sendto(message, client.udp_addr)
+        except OSError:
+            # Socket buffer full or receiver unreachable: this frame is lost, the next one replaces it
+            pass
 
+    def _answer_wait(self, client):
+        pending = self._pending(client, client.wait_seq)
+        if pending:
+            client.wait_seq = None
+            self._send_data(client, pending[0])
 
-    def _send_data(self, conn,data):
-        """ Send the image and serialized data over the socket. """
- #       ret, encoded_image = cv2.imencode('.jpg', image)
- #       if not ret:
- #          print("Could not encode image")
- #           return
+    def _answer_requests(self):
+        if self.snapshot is None:
+            # Nothing was sent yet, keep the requests for the first frame
+            return
+        now = time.monotonic()
+        for client in list(self.clients.values()):
+            if client.pending_requests and now >= client.next_send_time:
+                self._guarded(client, self._answer_request, client, now)
 
- #       image_data = encoded_image.tobytes()
-        json_data = json.dumps(data).encode('utf-8')
-        #print(json_data)
+    def _answer_request(self, client, now):
+        # The last frame of every camera of the client
+        latest = self._pending(client, 0)
+        if not latest:
+            return
+        client.pending_requests -= 1
+        client.next_send_time = now + self.poll_interval
+        for snapshot in latest:
+            self._send_data(client, snapshot)
+
+    def _disconnect(self, client):
+        if self.clients.pop(client.conn.fileno(), None) is None:
+            return
+        self.selector.unregister(client.conn)
+        client.conn.close()
+        print('Disconnected ', client.addr)
+        self._update_subscription()
+
+    def _send_data(self, client, snapshot):
+        """ Queue the snapshot, encoded for the client, and start sending it. """
+        with self.metrics.time('send'):
+            self._send_snapshot(client, snapshot)
+
+    def _send_snapshot(self, client, snapshot):
+        try:
+            messages = self._encode_snapshot(client, snapshot)
+        except _ENCODING_ERRORS as e:
+            # Not the fault of the client: the frame is skipped, the publisher gets the error
+            client.sent_seq = max(client.sent_seq, snapshot.seq)
+            self._encoding_failed(snapshot, e)
+            return
+        last_camera_seq = client.camera_seqs.get(snapshot.serial)
+        if client.streaming and last_camera_seq is not None:
+            # Every frame of the camera published since the last one sent was skipped
+            client.frames_dropped += max(0, snapshot.camera_seq - last_camera_seq - 1)
+        client.camera_seqs[snapshot.serial] = snapshot.camera_seq
+        client.sent_seq = snapshot.seq
+        client.frames_in_flight += 1
+        client.unacked.append(snapshot.seq)
+        self.count = self.count + 1
+        self._queue(client, *messages, seq=snapshot.seq)
+
+    def _encode_snapshot(self, client, snapshot):
+        """ The messages carrying the snapshot to this client. """
+        if client.framing == ubp.FRAMING_SENTINEL and self.image_encoder is not None:
+            # JSON<<END_OF_JSON>>JPEG<<END>>, as read by TcpClientBehaviour.cs
+            image = self.image
+            return (snapshot.payload(client.encoding, client.view), ubp.IMAGE_DELIMITER,
+                    image.data if image is not None else b'', ubp.SENTINEL)
+        if client.delta is not None:
+            payload = client.delta.encode(snapshot, client.view)
+            if payload is not None:
+                return (self._frame_message(client, ubp.MSG_DELTA, snapshot, payload),)
+        if client.compressor is not None:
+            flags = ubp.FLAG_BINARY if client.encoding == ubp.ENCODING_BINARY else 0
+            return (self._frame_message(client, ubp.MSG_DATA, snapshot, snapshot.payload(client.encoding, client.view), flags),)
+        return (snapshot.message(client.framing, client.encoding, client.view),)
+
+    def _encoding_failed(self, snapshot, error):
+        """ Report a frame the encoders rejected, once, to the log and the metrics. """
+        with self._frame_cond:
+            if snapshot.encoding_error is not None:
+                return
+            snapshot.encoding_error = error
+        print(f"UnityBridge: frame {snapshot.seq} could not be encoded, not sent: {error!r}")
+        self.metrics.inc('frames_unencodable_total')
+
+    def _frame_message(self, client, msg_type, snapshot, payload, flags=0):
+        """ A message built for this client only, compressed when negotiated and large enough. """
+        if client.compressor is not None and len(payload) >= self.compression_threshold:
+            compressed = client.compressor.compress(payload) + client.compressor.flush(zlib.Z_SYNC_FLUSH)
+            client.compressed_in += len(payload)
+            client.compressed_out += len(compressed)
+            payload = compressed
+            flags |= ubp.FLAG_COMPRESSED
+        return ubp.frame_message(client.framing, msg_type, snapshot.seq, payload, snapshot.timestamp, flags)
+
+    def _queue(self, client, *messages, seq=0):
+        for message in messages[:-1]:
+            client.outqueue.append((message, 0))
+        client.outqueue.append((messages[-1], seq))
+        client.out_bytes += sum(len(message) for message in messages)
+        self._flush(client)
+
+    def _flush(self, client):
+        """ Write as much of the pending output as the socket accepts. """
         try:
-            conn.sendall(json_data+b'<<END>>')
-#            conn.sendall(image_data+b'<<END>>')
-            self.count = self.count + 1
+            while client.outqueue:
+                message, seq = client.outqueue[0]
+                sent = client.conn.send(memoryview(message)[client.out_offset:])
+                client.out_offset += sent
+                client.out_bytes -= sent
+                self.metrics.inc('bytes_sent_total', sent)
+                if client.out_offset < len(message):
+                    break
+                client.outqueue.popleft()
+                client.out_offset = 0
+                if seq:
+                    client.frames_in_flight -= 1
+                    client.frames_delivered += 1
+                    client.delivery_rate.tick(time.monotonic())
+        except (BlockingIOError, InterruptedError):
+            pass
         except socket.error as e:
             print(f"Error sending data: {e}")
+            self._disconnect(client)
+            return
+        events = selectors.EVENT_READ
+        if client.outqueue:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(client.conn, events, client)
+        if not client.outqueue:
+            self._catch_up(client)
 
 
 class TestObject:
@@ -155,3 +1222,44 @@ class TestObject:
         self.result = result
         self.field1 = None
         self.arr1 = []
+
+
+def add_arguments(parser, images=True, record=True):
+    """ Command line options of the bridge features shared by the launch scripts, applied by configure().
+
+    images: add the image stream options, for the scripts that send color frames
+    record: add --record, left out by the replay script
+    """
+    parser.add_argument('--shm', action="store_true",
+                        help="Also publish the hands to a shared-memory ring buffer for consumers on the same host")
+    if record:
+        parser.add_argument('--record', metavar="PATH",
+                            help="Append every frame sent to a log file, see replay_unity_bridge.py")
+    parser.add_argument('--prediction', action="store_true",
+                        help="Track the velocity of the hands, for the clients asking for predicted poses (HELO predict_ms)")
+    parser.add_argument('--metrics_port', type=int,
+                        help="Serve the stage timings in the Prometheus text format on http://127.0.0.1:METRICS_PORT/metrics")
+    if images:
+        parser_images = parser.add_argument_group("Image stream arguments")
+        parser_images.add_argument('--images', action="store_true",
+                                   help="Send the color frames to Unity as JPEG images")
+        parser_images.add_argument('--image_scale', type=float, default=0.5,
+                                   help="Downscale factor of the sent images (default=%(default)s)")
+        parser_images.add_argument('--jpeg_quality', type=int, default=80,
+                                   help="JPEG quality of the sent images (default=%(default)i)")
+        parser_images.add_argument('--image_skip', type=int, default=1,
+                                   help="Send one frame out of IMAGE_SKIP (default=%(default)i)")
+
+
+def configure(unity_bridge, args):
+    """ Enable the features asked for with the options of add_arguments(), before start(). """
+    if getattr(args, 'images', False):
+        unity_bridge.enable_images(scale=args.image_scale, quality=args.jpeg_quality, skip=args.image_skip)
+    if args.shm:
+        unity_bridge.enable_shared_memory()
+    if getattr(args, 'record', None):
+        unity_bridge.enable_recording(args.record)
+    if args.prediction:
+        unity_bridge.enable_prediction()
+    if args.metrics_port:
+        unity_bridge.enable_metrics(args.metrics_port)
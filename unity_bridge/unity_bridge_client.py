@@ -0,0 +1,200 @@
+import json
+import socket
+import struct
+import zlib
+from collections import OrderedDict
+import unity_bridge_protocol as ubp
+
+_RECV_SIZE = 65536
+# Delta mode: frames kept as possible bases, as many as the bridge keeps unacknowledged
+_DELTA_FRAMES = 64
+
+
+class UdpFrameReceiver:
+    """ Receives the frames of the UnityBridge UDP mode.
+
+    Bind it, then ask for the UDP mode with HELO {"udp_port": receiver.port,
+    "framing": "header", "encoding": "binary"} on the TCP connection. Datagrams that arrive late (sequence number not newer
+    than the last frame returned) are discarded and counted in `stale`.
+    """
+    def __init__(self, host='0.0.0.0', port=0):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.port = self.socket.getsockname()[1]
+        self.last_seq = 0
+        self.stale = 0
+
+    def receive(self, timeout=None):
+        """ The newest frame as (seq, timestamp, data), None on timeout.
+
+        Waits for a first datagram, then drains the socket so only the most recent
+        frame already received is returned.
+        """
+        newest = None
+        self.socket.settimeout(timeout)
+        while True:
+            try:
+                datagram = self.socket.recv(65536)
+            except (socket.timeout, BlockingIOError):
+                break
+            self.socket.settimeout(0)
+            try:
+                msg_type, flags, seq, timestamp, length = ubp.unpack_header(datagram)
+            except (ValueError, struct.error):
+                continue
+            if msg_type != ubp.MSG_DATA or length != len(datagram) - ubp.HEADER_SIZE:
+                continue
+            if seq <= self.last_seq:
+                self.stale += 1
+                continue
+            self.last_seq = seq
+            newest = (seq, timestamp, flags, datagram[ubp.HEADER_SIZE:])
+        if newest is None:
+            return None
+        seq, timestamp, flags, payload = newest
+        return seq, timestamp, ubp.decode_payload(flags, payload)
+
+    def close(self):
+        self.socket.close()
+
+
+class FrameClient:
+    """ TCP client of UnityBridge, reading the frames as TcpClientBehaviour.cs does.
+
+    options: HELO options, e.g. {"framing": "header", "encoding": "binary"}. Without
+    options no HELO is sent and the bridge uses its default framing (sentinel).
+    acknowledge: send ACKN after every frame (always done in delta mode).
+    The answer to HELO is kept in `hello`.
+    """
+    def __init__(self, address, options=None, acknowledge=False, timeout=5.0):
+        self.socket = socket.create_connection(address, timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = bytearray()
+        self.framing = ubp.FRAMING_SENTINEL
+        self.acknowledge = acknowledge
+        self.hello = None
+        self.image = None
+        # Last readiness reported by the bridge (MSG_STATUS)
+        self.status = None
+        # Bridge clock minus client clock, and round trip of the measure, in microseconds, see sync_clock()
+        self.clock_offset = None
+        self.clock_rtt = None
+        self.bytes_received = 0
+        # Delta mode: seq -> flattened frame, for the frames a delta can be based on
+        self.frames = OrderedDict()
+        # Compression: one decompressor for the whole connection
+        self.decompressor = zlib.decompressobj()
+        if options is not None:
+            self.framing = options.get("framing", ubp.FRAMING_SENTINEL)
+            if self.framing not in ubp.FRAMINGS:
+                self.framing = ubp.FRAMING_SENTINEL
+            self.socket.sendall(ubp.pack_command(ubp.CMD_HELLO, json.dumps(options).encode('utf-8')))
+            # The answer is a MSG_HELLO, or a plain sentinel-terminated JSON
+            msg_type, flags, seq, timestamp, payload = self._read_message()
+            self.hello = json.loads(bytes(payload).decode('utf-8'))
+            if "error" in self.hello:
+                raise ValueError(self.hello["error"])
+            self.status = self.hello.get("status")
+            if self.hello.get("delta"):
+                self.acknowledge = True
+
+    def sync_clock(self, samples=8):
+        """ Measure the offset of the bridge clock with TIME (header framing), before subscribe().
+
+        The exchange with the shortest round trip gives the offset, kept in
+        clock_offset: a bridge timestamp (publishTime, captureTime) minus
+        clock_offset is a local ubp.timestamp_us().
+        """
+        for _ in range(samples):
+            self.socket.sendall(ubp.CMD_TIME + ubp.COMMAND_TIME.pack(ubp.timestamp_us()))
+            while True:
+                msg_type, flags, seq, timestamp, payload = self._read_message()
+                if msg_type == ubp.MSG_TIME:
+                    break
+                if msg_type == ubp.MSG_STATUS:
+                    self.status = json.loads(bytes(payload).decode('utf-8'))
+            received = ubp.timestamp_us()
+            answer = json.loads(bytes(payload).decode('utf-8'))
+            rtt = (received - answer["client"]) - (answer["send"] - answer["receive"])
+            if self.clock_rtt is None or rtt < self.clock_rtt:
+                self.clock_rtt = rtt
+                self.clock_offset = ((answer["receive"] - answer["client"]) + (answer["send"] - received)) / 2
+        return self.clock_offset
+
+    def request(self):
+        """ Request/response mode: ask for the last frame and return it as (seq, timestamp, data). """
+        self.socket.sendall(ubp.CMD_DATA)
+        return self.receive()
+
+    def subscribe(self):
+        """ Push mode: the bridge sends every new frame, read them with receive(). """
+        self.socket.sendall(ubp.CMD_SUBSCRIBE)
+
+    def wait(self, after_seq):
+        """ Long poll: the first frame newer than after_seq, as (seq, timestamp, data). """
+        self.socket.sendall(ubp.CMD_WAIT + ubp.COMMAND_SEQ.pack(after_seq))
+        return self.receive()
+
+    def receive(self):
+        """ The next frame as (seq, timestamp, data), seq and timestamp are None with the sentinel framing. """
+        while True:
+            msg_type, flags, seq, timestamp, payload = self._read_message()
+            if msg_type == ubp.MSG_IMAGE:
+                self.image = (seq, timestamp, bytes(payload))
+                continue
+            if msg_type == ubp.MSG_STATUS:
+                self.status = json.loads(bytes(payload).decode('utf-8'))
+                continue
+            if flags & ubp.FLAG_COMPRESSED:
+                payload = self.decompressor.decompress(payload)
+            if msg_type == ubp.MSG_DELTA:
+                delta = json.loads(bytes(payload).decode('utf-8'))
+                flat = ubp.apply_delta(self.frames[delta["base"]], delta, self.hello["quantum"])
+                data = ubp.unflatten(flat)
+            elif msg_type == ubp.MSG_DATA:
+                if self.framing == ubp.FRAMING_SENTINEL and ubp.IMAGE_DELIMITER in payload:
+                    payload, image = bytes(payload).split(ubp.IMAGE_DELIMITER, 1)
+                    self.image = (None, None, image)
+                data = ubp.decode_payload(flags, payload)
+                flat = ubp.flatten(data) if self.hello and self.hello.get("delta") else None
+            else:
+                continue
+            if flat is not None:
+                self.frames[seq] = flat
+                while len(self.frames) > _DELTA_FRAMES:
+                    self.frames.popitem(last=False)
+            if self.acknowledge and seq is not None:
+                self.socket.sendall(ubp.CMD_ACK + ubp.COMMAND_SEQ.pack(seq))
+            return seq, timestamp, data
+
+    def _read_message(self):
+        """ (msg_type, flags, seq, timestamp, payload) of the next message. """
+        if self.framing == ubp.FRAMING_HEADER:
+            while True:
+                if len(self.buffer) >= ubp.HEADER_SIZE:
+                    msg_type, flags, seq, timestamp, length = ubp.unpack_header(self.buffer)
+                    end = ubp.HEADER_SIZE + length
+                    if len(self.buffer) >= end:
+                        payload = bytes(self.buffer[ubp.HEADER_SIZE:end])
+                        del self.buffer[:end]
+                        return msg_type, flags, seq, timestamp, payload
+                self._recv()
+        start = 0
+        while True:
+            end = self.buffer.find(ubp.SENTINEL, start)
+            if end >= 0:
+                payload = bytes(self.buffer[:end])
+                del self.buffer[:end + len(ubp.SENTINEL)]
+                return ubp.MSG_DATA, 0, None, None, payload
+            start = max(0, len(self.buffer) - len(ubp.SENTINEL) + 1)
+            self._recv()
+
+    def _recv(self):
+        data = self.socket.recv(_RECV_SIZE)
+        if not data:
+            raise ConnectionError("Connection closed by the bridge")
+        self.bytes_received += len(data)
+        self.buffer += data
+
+    def close(self):
+        self.socket.close()
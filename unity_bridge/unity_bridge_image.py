@@ -0,0 +1,76 @@
+import threading
+from collections import namedtuple
+import cv2
+import numpy as np
+
+# A JPEG image of the frame published with sequence number `seq`
+EncodedImage = namedtuple('EncodedImage', ['seq', 'timestamp', 'data'])
+
+
+class ImageEncoder:
+    """ Encodes color frames to JPEG on worker threads, off the tracking thread.
+
+    Only one frame out of `skip` is kept, downscaled by `scale` before encoding.
+    There is a single pending slot: when the workers fall behind, the newest frame
+    replaces the one waiting, and an image finished after a newer one is dropped.
+    `callback(image)` receives every EncodedImage, from a worker thread.
+    """
+    def __init__(self, callback, scale=0.5, quality=80, skip=1, workers=2):
+        if skip < 1:
+            raise ValueError("skip must be at least 1")
+        self.callback = callback
+        self.scale = scale
+        self.quality = quality
+        self.skip = skip
+        self.frames_encoded = 0
+        self.frames_dropped = 0
+        self._count = 0
+        self._pending = None
+        self._last_seq = 0
+        self._running = True
+        self._cond = threading.Condition()
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, frame, seq, timestamp):
+        self._count += 1
+        if (self._count - 1) % self.skip:
+            return
+        # The tracker can reuse the buffer of its frame, the workers need their own copy
+        frame = np.array(frame, copy=True)
+        with self._cond:
+            if self._pending is not None:
+                self.frames_dropped += 1
+            self._pending = (seq, timestamp, frame)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+    def _work(self):
+        params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None or not self._running)
+                if not self._running:
+                    return
+                seq, timestamp, frame = self._pending
+                self._pending = None
+            if self.scale != 1:
+                frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+            ret, encoded_image = cv2.imencode('.jpg', frame, params)
+            if not ret:
+                print("Could not encode image")
+                continue
+            with self._cond:
+                if seq <= self._last_seq:
+                    self.frames_dropped += 1
+                    continue
+                self._last_seq = seq
+                self.frames_encoded += 1
+            self.callback(EncodedImage(seq, timestamp, encoded_image.tobytes()))
@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+# Per-stage timings, kept as a rolling window of the last durations of each
+# stage, and counters, served in the Prometheus text format:
+#
+#   unity_bridge_stage_seconds{stage="process",quantile="0.5"} 0.0123
+#   unity_bridge_stage_seconds_sum{stage="process"} 12.5
+#   unity_bridge_stage_seconds_count{stage="process"} 1000
+#   unity_bridge_frames_published_total 1000
+#
+# The quantiles cover the window, _sum and _count everything since the start.
+
+QUANTILES = (0.5, 0.95, 0.99)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class StageHistogram:
+    """ The last `window` durations of a stage, in seconds, and running totals. """
+    def __init__(self, window=1024):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.sum += seconds
+
+    def quantiles(self, quantiles=QUANTILES):
+        if not self.samples:
+            return [float('nan')] * len(quantiles)
+        return np.quantile(np.fromiter(self.samples, dtype=np.float64), quantiles).tolist()
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels.items()) + '}'
+
+
+class Metrics:
+    """ Stage timings and counters of a tracker and its UnityBridge.
+
+    Stages are timed with `with metrics.time("stage"):` or observe(), from any thread.
+    Collectors add values computed at scrape time: add_collector(fn), where fn()
+    returns [(name, type, help, [(labels, value), ...]), ...].
+    """
+    def __init__(self, prefix='unity_bridge', window=1024):
+        self.prefix = prefix
+        self.window = window
+        self.stages = {}
+        self.counters = {}
+        self.collectors = []
+        self.server = None
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = StageHistogram(self.window)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def summary(self):
+        """ {stage: {"p50": s, "p95": s, "p99": s, "count": n}} """
+        with self._lock:
+            stages = {stage: (histogram.quantiles(), histogram.count) for stage, histogram in self.stages.items()}
+        return {stage: {"p50": p50, "p95": p95, "p99": p99, "count": count}
+                for stage, ((p50, p95, p99), count) in stages.items()}
+
+    def render(self):
+        """ All the metrics in the Prometheus text exposition format. """
+        lines = []
+        name = f"{self.prefix}_stage_seconds"
+        with self._lock:
+            stages = [(stage, histogram.quantiles(), histogram.sum, histogram.count)
+                      for stage, histogram in sorted(self.stages.items())]
+            counters = sorted(self.counters.items())
+        if stages:
+            lines.append(f"# HELP {name} Duration of each processing stage, over the last {self.window} frames")
+            lines.append(f"# TYPE {name} summary")
+            for stage, quantiles, total, count in stages:
+                for quantile, value in zip(QUANTILES, quantiles):
+                    lines.append(f"{name}{_labels({'stage': stage, 'quantile': quantile})} {value!r}")
+                lines.append(f"{name}_sum{_labels({'stage': stage})} {total!r}")
+                lines.append(f"{name}_count{_labels({'stage': stage})} {count}")
+        for counter, value in counters:
+            lines.append(f"# TYPE {self.prefix}_{counter} counter")
+            lines.append(f"{self.prefix}_{counter} {value}")
+        for collector in self.collectors:
+            for metric, metric_type, help_text, samples in collector():
+                lines.append(f"# HELP {self.prefix}_{metric} {help_text}")
+                lines.append(f"# TYPE {self.prefix}_{metric} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{self.prefix}_{metric}{_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """ Serve render() on http://host:port/metrics from a background thread. """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f"Metrics on http://{host}:{self.server.server_address[1]}/metrics")
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
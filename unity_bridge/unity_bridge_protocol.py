@@ -0,0 +1,379 @@
+import json
+import struct
+import time
+import numpy as np
+
+# Wire format shared by UnityBridge and its clients.
+#
+# A client starts with a 4-byte ASCII command. HELO is followed by a uint32
+# (little-endian) length and a JSON object with the requested options, e.g.
+#   b'HELO' + struct.pack('<I', len(options)) + b'{"framing": "header"}'
+# Clients that never send HELO keep the legacy format: JSON followed by the
+# b'<<END>>' sentinel.
+#
+# With "framing": "header" every message starts with a fixed header:
+#   magic     2s   b'UB'
+#   version   B    PROTOCOL_VERSION
+#   type      B    MSG_*
+#   flags     H    FLAG_* bits describing the payload
+#   seq       I    frame sequence number (0 for control messages)
+#   timestamp Q    publish time in microseconds since the epoch
+#   length    I    payload size in bytes
+# followed by exactly `length` bytes of payload.
+#
+# With "encoding": "binary" (header framing only) DATA payloads are packed
+# instead of JSON, see encode_binary().
+#
+# With "compression": "zlib" (header framing only) DATA and DELTA payloads of
+# at least "compression_threshold" bytes (given in the HELLO answer) are
+# compressed and flagged FLAG_COMPRESSED. The compressor is kept for the whole
+# connection and flushed with Z_SYNC_FLUSH after each message: the client
+# decompresses the flagged payloads, in order, with a single zlib
+# decompressobj(). The header flags still describe the decompressed payload.
+#
+# Every frame carries "publishTime", the header timestamp, and "captureTime"
+# when the tracker knows when the camera took the picture, both in
+# microseconds since the epoch of the bridge clock. TIME (header framing only)
+# measures the offset between the client and bridge clocks:
+#   b'TIME' + struct.pack('<Q', client time in microseconds)
+# is answered right away with a MSG_TIME whose JSON payload holds the client
+# time sent, and the bridge times the command was received and answered:
+#   {"client": t0, "receive": t1, "send": t2}
+# With t3 the client time the answer arrived, the offset of the bridge clock is
+# ((t1 - t0) + (t2 - t3)) / 2, most accurate for the exchange with the
+# shortest round trip (t3 - t0) - (t2 - t1). See FrameClient.sync_clock().
+#
+# With HELO "predict_ms" (bridge started with prediction enabled) the float
+# fields of the hands tracked over the last frames ("xyz" and the landmarks)
+# are extrapolated that many milliseconds past their capture time, from the
+# velocity of each hand, to hide the latency between capture and rendering.
+
+MAGIC = b'UB'
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('<2sBBHIQI')
+HEADER_SIZE = HEADER.size
+
+# Message types
+MSG_DATA = 1  # serialized frame
+MSG_HELLO = 2  # answer to HELO, JSON with the accepted options
+MSG_DELTA = 3  # JSON changes against an acknowledged frame, see apply_delta()
+MSG_IMAGE = 4  # JPEG color image, seq of the frame it belongs to
+MSG_STATUS = 5  # JSON readiness of the bridge and its tracker, sent when it changes, see READY_STAGES
+MSG_TIME = 6  # JSON answer to TIME, bridge clock at reception and answer
+
+# Header flags
+FLAG_BINARY = 0x0001  # payload uses the packed binary encoding
+FLAG_COMPRESSED = 0x0002  # payload is a zlib chunk of the connection stream
+
+# Framing modes
+FRAMING_SENTINEL = 'sentinel'
+FRAMING_HEADER = 'header'
+FRAMINGS = (FRAMING_SENTINEL, FRAMING_HEADER)
+
+SENTINEL = b'<<END>>'
+# Sentinel framing with images (TcpClientBehaviour.cs): JSON, this delimiter, JPEG, SENTINEL
+IMAGE_DELIMITER = b'<<END_OF_JSON>>'
+
+# UDP mode: one datagram per frame, header framing and binary encoding, no IP
+# fragmentation on Ethernet
+UDP_MAX_DATAGRAM = 1472
+
+# Startup stages, in order, reported in MSG_STATUS and in the HELLO answer as
+# {"stages": {stage: timestamp in microseconds}, "ready": bool}. "ready" is set
+# once the first inference is done.
+READY_LISTENING = 'listening'  # the bridge accepts and serves clients
+READY_STREAMING = 'streaming'  # the camera delivers frames
+READY_FIRST_INFERENCE = 'first_inference'  # the first frame was tracked and published
+READY_STAGES = (READY_LISTENING, READY_STREAMING, READY_FIRST_INFERENCE)
+
+# Compression, negotiated with HELO "compression"
+COMPRESSION_ZLIB = 'zlib'
+
+# Payload encodings
+ENCODING_JSON = 'json'
+ENCODING_BINARY = 'binary'
+ENCODINGS = (ENCODING_JSON, ENCODING_BINARY)
+
+CMD_DATA = b'DATA'
+CMD_SUBSCRIBE = b'SUBS'
+CMD_HELLO = b'HELO'
+COMMAND_LENGTH = struct.Struct('<I')
+# WAIT is followed by a uint32 sequence number, the answer is the first frame newer than it
+CMD_WAIT = b'WAIT'
+# ACKN is followed by the uint32 sequence number of the last frame decoded (delta mode,
+# and push mode backpressure: a client keeps at most max_unacked frames unacknowledged)
+CMD_ACK = b'ACKN'
+COMMAND_SEQ = struct.Struct('<I')
+# TIME is followed by the uint64 client time in microseconds, see MSG_TIME
+CMD_TIME = b'TIME'
+COMMAND_TIME = struct.Struct('<Q')
+
+
+def timestamp_us(t=None):
+    """ Microseconds since the epoch, as stored in the frame header. """
+    if t is None:
+        t = time.time()
+    return int(t * 1000000)
+
+
+def pack_header(msg_type, seq, length, timestamp=None, flags=0):
+    if timestamp is None:
+        timestamp = timestamp_us()
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, msg_type, flags, seq & 0xFFFFFFFF, timestamp, length)
+
+
+def frame_message(framing, msg_type, seq, payload, timestamp=None, flags=0):
+    """ The payload framed as negotiated: header + payload, or payload + sentinel. """
+    if framing == FRAMING_HEADER:
+        return pack_header(msg_type, seq, len(payload), timestamp, flags) + payload
+    return payload + SENTINEL
+
+
+def unpack_header(data, offset=0):
+    """ Returns (msg_type, flags, seq, timestamp, length) of the header at offset. """
+    magic, version, msg_type, flags, seq, timestamp, length = HEADER.unpack_from(data, offset)
+    if magic != MAGIC:
+        raise ValueError("Bad frame magic: %r" % magic)
+    if version != PROTOCOL_VERSION:
+        raise ValueError("Unsupported protocol version: %d" % version)
+    return msg_type, flags, seq, timestamp, length
+
+
+def decode_payload(flags, payload):
+    """ A DATA payload as a dict, whatever its encoding. """
+    if flags & FLAG_BINARY:
+        return decode_binary(payload)
+    return json.loads(bytes(payload).decode('utf-8'))
+
+
+def pack_command(command, payload=b''):
+    """ Client side helper: a command, with a length-prefixed payload if any. """
+    if not payload:
+        return command
+    return command + COMMAND_LENGTH.pack(len(payload)) + payload
+
+
+def json_default(value):
+    """ json.dumps() hook for the numpy values found in tracker objects. """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_json(data):
+    return json.dumps(data, default=json_default).encode('utf-8')
+
+
+# Binary encoding
+#
+#   count   H    number of entries
+#   count schema entries:
+#     key     B + utf-8   object name ("hand_0"), empty for top-level values ("serialNumber")
+#     field   B + utf-8   field name ("rotated_world_landmarks")
+#     dtype   B           DTYPE_*
+#     ndim    B           followed by ndim H dimensions
+#     size    I           byte size of the data block
+#   data blocks, in the order of the schema entries
+#
+# Floating point values (numpy arrays, floats and nested lists of floats) are
+# packed as little-endian float32 blocks, anything else as a JSON block. Fields
+# with a precision policy (see quantize()) use smaller blocks: "mm" as int16
+# millimetres, "f16" as float16. Both are decoded to float32 arrays.
+
+DTYPE_JSON = 0
+DTYPE_FLOAT32 = 1
+DTYPE_FLOAT16 = 2
+DTYPE_INT16_MM = 3
+
+_COUNT = struct.Struct('<H')
+_NAME_LENGTH = struct.Struct('<B')
+_ENTRY = struct.Struct('<BB')
+_DIM = struct.Struct('<H')
+_SIZE = struct.Struct('<I')
+_FLOAT32_LE = np.dtype('<f4')
+_FLOAT16_LE = np.dtype('<f2')
+_INT16_LE = np.dtype('<i2')
+
+
+def float_array(value, dtype=np.float64):
+    """ The value as a float array, or None if it is not floating point data. """
+    if isinstance(value, np.ndarray):
+        return value.astype(dtype, copy=False) if value.dtype.kind == 'f' else None
+    if isinstance(value, (float, np.floating)):
+        return np.asarray(value, dtype=dtype)
+    if isinstance(value, (list, tuple)) and value:
+        try:
+            array = np.asarray(value)
+        except ValueError:
+            return None
+        if array.dtype.kind == 'f':
+            return array.astype(dtype, copy=False)
+    return None
+
+
+def _float_block(value):
+    return float_array(value, _FLOAT32_LE)
+
+
+# Precision policies, given in a serialization config as "field:policy", e.g.
+# ['label', 'xyz:mm', 'get_rotated_world_landmarks:f16']
+#   d<N>  rounded to N decimals (d0 to d9)
+#   mm    rounded to the millimetre (values in meters), int16 in the binary encoding
+#   f16   float16 precision, float16 in the binary encoding
+PRECISION_MM = 'mm'
+PRECISION_FLOAT16 = 'f16'
+
+
+def check_precision(policy):
+    if policy in (PRECISION_MM, PRECISION_FLOAT16):
+        return policy
+    if len(policy) == 2 and policy[0] == 'd' and policy[1].isdigit():
+        return policy
+    raise ValueError(f"Unknown precision policy: {policy}")
+
+
+def quantize(value, policy):
+    """ The floating point data of a value rounded as the policy says, as the clients decode it.
+
+    The rounded values are float64 with a short repr, so the JSON encoding gets
+    smaller too. Values that are not floating point data are returned unchanged.
+    """
+    array = float_array(value)
+    if array is None:
+        return value
+    if policy == PRECISION_MM:
+        array = np.round(array, 3)
+    elif policy == PRECISION_FLOAT16:
+        # Decimals matching the float16 precision at the largest magnitude
+        array = array.astype(np.float16).astype(np.float64)
+        largest = np.abs(array).max() if array.size else 0
+        decimals = 3 - int(np.floor(np.log10(largest))) if largest > 0 and np.isfinite(largest) else 3
+        array = np.round(array, max(0, decimals))
+    else:
+        array = np.round(array, int(policy[1]))
+    return array.item() if array.ndim == 0 else array
+
+
+def _pack_name(name):
+    name = name.encode('utf-8')
+    return _NAME_LENGTH.pack(len(name)) + name
+
+
+def encode_binary(data, precisions=None):
+    """ precisions: {(key, field): policy} of the fields given a precision policy. """
+    entries = []
+    for key, value in data.items():
+        if isinstance(value, dict):
+            entries.extend((key, field, field_value) for field, field_value in value.items())
+        else:
+            entries.append(("", key, value))
+
+    schema = [_COUNT.pack(len(entries))]
+    blocks = []
+    for key, field, value in entries:
+        policy = precisions.get((key, field)) if precisions else None
+        array = _float_block(value)
+        if array is not None:
+            dtype = DTYPE_FLOAT32
+            if policy == PRECISION_MM:
+                array, dtype = np.clip(np.round(array * 1000), -32768, 32767).astype(_INT16_LE), DTYPE_INT16_MM
+            elif policy == PRECISION_FLOAT16:
+                array, dtype = array.astype(_FLOAT16_LE), DTYPE_FLOAT16
+            block = array.tobytes()
+            schema.append(_pack_name(key) + _pack_name(field) + _ENTRY.pack(dtype, array.ndim))
+            schema.extend(_DIM.pack(dim) for dim in array.shape)
+        else:
+            block = json.dumps(value, default=json_default).encode('utf-8')
+            schema.append(_pack_name(key) + _pack_name(field) + _ENTRY.pack(DTYPE_JSON, 0))
+        schema.append(_SIZE.pack(len(block)))
+        blocks.append(block)
+    return b''.join(schema + blocks)
+
+
+def _unpack_name(payload, offset):
+    length, = _NAME_LENGTH.unpack_from(payload, offset)
+    offset += _NAME_LENGTH.size
+    return bytes(payload[offset:offset + length]).decode('utf-8'), offset + length
+
+
+def decode_binary(payload):
+    """ Inverse of encode_binary(), float blocks are returned as float32 arrays. """
+    count, = _COUNT.unpack_from(payload, 0)
+    offset = _COUNT.size
+    schema = []
+    for _ in range(count):
+        key, offset = _unpack_name(payload, offset)
+        field, offset = _unpack_name(payload, offset)
+        dtype, ndim = _ENTRY.unpack_from(payload, offset)
+        offset += _ENTRY.size
+        shape = tuple(_DIM.unpack_from(payload, offset + i * _DIM.size)[0] for i in range(ndim))
+        offset += ndim * _DIM.size
+        size, = _SIZE.unpack_from(payload, offset)
+        offset += _SIZE.size
+        schema.append((key, field, dtype, shape, size))
+
+    data = {}
+    for key, field, dtype, shape, size in schema:
+        block = payload[offset:offset + size]
+        offset += size
+        if dtype == DTYPE_FLOAT32:
+            value = np.frombuffer(block, dtype=_FLOAT32_LE).reshape(shape)
+        elif dtype == DTYPE_FLOAT16:
+            value = np.frombuffer(block, dtype=_FLOAT16_LE).astype(np.float32).reshape(shape)
+        elif dtype == DTYPE_INT16_MM:
+            value = (np.frombuffer(block, dtype=_INT16_LE) / np.float32(1000)).astype(np.float32).reshape(shape)
+        else:
+            value = json.loads(bytes(block).decode('utf-8'))
+        if key:
+            data.setdefault(key, {})[field] = value
+        else:
+            data[field] = value
+    return data
+
+
+# Delta encoding
+#
+# A delta frame (MSG_DELTA) is a JSON object describing the changes against a
+# frame the client already decoded and acknowledged with ACKN:
+#   {"base": seq of that frame,
+#    "set": [[key, field, value], ...],     new or changed values
+#    "add": [[key, field, steps], ...],    float fields: value = base + steps * quantum
+#    "remove": [[key, field], ...]}
+# Top-level values ("serialNumber") use the key "". Full frames (MSG_DATA) are
+# keyframes. The quantum is given in the HELLO answer.
+
+
+def flatten(data):
+    """ {(key, field): value} view of a frame, top-level values use the key "". """
+    flat = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            for field, field_value in value.items():
+                flat[(key, field)] = field_value
+        else:
+            flat[("", key)] = value
+    return flat
+
+
+def unflatten(flat):
+    data = {}
+    for (key, field), value in flat.items():
+        if key:
+            data.setdefault(key, {})[field] = value
+        else:
+            data[field] = value
+    return data
+
+
+def apply_delta(base, delta, quantum):
+    """ Client side: the flattened frame described by a delta on top of the flattened base frame. """
+    flat = dict(base)
+    for key, field in delta.get("remove", []):
+        flat.pop((key, field), None)
+    for key, field, value in delta.get("set", []):
+        flat[(key, field)] = value
+    for key, field, steps in delta.get("add", []):
+        flat[(key, field)] = np.asarray(flat[(key, field)], dtype=np.float64) + np.asarray(steps) * quantum
+    return flat
@@ -0,0 +1,104 @@
+import json
+import struct
+import threading
+from collections import deque
+import unity_bridge_protocol as ubp
+
+# Append-only log of the frames published by UnityBridge, replayed by
+# replay_unity_bridge.py.
+#
+# file header
+#   magic      4s   b'UBRC'
+#   version    I    RECORD_VERSION
+# then one record per frame
+#   seq        I    frame sequence number
+#   timestamp  Q    publish time in microseconds since the epoch
+#   length     I    payload size in bytes
+#   payload         the frame as JSON (the "json" encoding of the snapshot)
+#
+# A log cut by a crash is read up to its last complete record.
+
+RECORD_MAGIC = b'UBRC'
+RECORD_VERSION = 1
+FILE_HEADER = struct.Struct('<4sI')
+RECORD = struct.Struct('<IQI')
+
+
+class FrameRecorder:
+    """ Appends the published snapshots to a log file, from a background thread.
+
+    The JSON payload of a snapshot is the one sent to the JSON clients, so it is
+    usually encoded once for both.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.frames_recorded = 0
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(FILE_HEADER.pack(RECORD_MAGIC, RECORD_VERSION))
+        else:
+            # Appending to an earlier recording: records of another format would make it unreadable
+            with open(path, 'rb') as f:
+                header = f.read(FILE_HEADER.size)
+            if len(header) < FILE_HEADER.size or FILE_HEADER.unpack(header) != (RECORD_MAGIC, RECORD_VERSION):
+                self._file.close()
+                raise ValueError(f"{path} is not a UnityBridge recording (version {RECORD_VERSION}), not appending to it")
+        self._pending = deque()
+        self._running = True
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def record(self, snapshot):
+        with self._cond:
+            self._pending.append(snapshot)
+            self._cond.notify()
+
+    def close(self):
+        """ Write the frames still pending and close the file. """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+        self._file.close()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or not self._running)
+                snapshots = list(self._pending)
+                self._pending.clear()
+                running = self._running
+            for snapshot in snapshots:
+                try:
+                    payload = snapshot.payload(ubp.ENCODING_JSON)
+                except (TypeError, ValueError, OverflowError) as e:
+                    # Reported to the publisher by UnityBridge, the log goes on without it
+                    print(f"FrameRecorder: frame {snapshot.seq} could not be encoded, not recorded: {e!r}")
+                    continue
+                self._file.write(RECORD.pack(snapshot.seq & 0xFFFFFFFF, snapshot.timestamp, len(payload)))
+                self._file.write(payload)
+                self.frames_recorded += 1
+            self._file.flush()
+            if not running:
+                return
+
+
+def read_frames(path):
+    """ Yields (seq, timestamp, data) for every complete record of a log. """
+    with open(path, 'rb') as f:
+        header = f.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size:
+            return
+        magic, version = FILE_HEADER.unpack(header)
+        if magic != RECORD_MAGIC or version != RECORD_VERSION:
+            raise ValueError(f"{path} is not a UnityBridge recording (version {RECORD_VERSION})")
+        while True:
+            record = f.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return
+            seq, timestamp, length = RECORD.unpack(record)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield seq, timestamp, json.loads(payload.decode('utf-8'))
@@ -0,0 +1,213 @@
+import mmap
+import os
+import struct
+import tempfile
+import time
+import cv2
+import numpy as np
+
+# Shared-memory ring buffer transport for consumers on the same host.
+#
+# A file is memory-mapped by the bridge (ShmRingWriter) and by the readers.
+# It starts with a header followed by `slot_count` fixed-size slots:
+#
+# header (64 bytes)
+#   magic       4s   b'UBSM'
+#   version     I    SHM_VERSION
+#   slot_count  I
+#   slot_size   I    bytes per slot
+#   max_hands   I    hand records per slot
+#   image_w     I    pixels kept per slot, 0 when images are disabled
+#   image_h     I
+#   channels    I
+#   latest      Q    sequence number of the last committed frame
+# slot
+#   lock        Q    seqlock counter, odd while the slot is being written
+#   seq         Q    frame sequence number
+#   timestamp   Q    publish time in microseconds since the epoch
+#   serial      32s  serial number of the camera, utf-8, zero padded
+#   hands       I    number of valid hand records
+#   image_size  I    number of valid image bytes, 0 if no image
+#   max_hands hand records:
+#     label     B    0 unknown, 1 left, 2 right
+#     pad       3x
+#     lm_score  f
+#     rotation  f
+#     xyz       3f
+#     landmarks 21*3f
+#   image       image_w * image_h * channels bytes (BGR)
+#
+# Floats are little-endian float32. A reader copies a slot and checks that
+# its lock did not change meanwhile and is even, otherwise it retries.
+
+SHM_MAGIC = b'UBSM'
+SHM_VERSION = 1
+SHM_HEADER = struct.Struct('<4sIIIIIIIQ')
+SHM_HEADER_SIZE = 64
+_LATEST_OFFSET = SHM_HEADER.size - 8
+SLOT_HEADER = struct.Struct('<QQQ32sII')
+_LOCK = struct.Struct('<Q')
+NB_LANDMARKS = 21
+HAND_RECORD = np.dtype([
+    ('label', 'u1'),
+    ('pad', 'u1', 3),
+    ('lm_score', '<f4'),
+    ('rotation', '<f4'),
+    ('xyz', '<f4', 3),
+    ('landmarks', '<f4', (NB_LANDMARKS, 3)),
+])
+LABELS = {None: 0, "left": 1, "right": 2}
+LABEL_NAMES = {code: label for label, code in LABELS.items()}
+# Landmark fields looked up in the serialized hands, by order of preference
+LANDMARK_FIELDS = ('rotated_world_landmarks', 'world_landmarks', 'landmarks')
+
+# How many times a reader retries a slot being written before giving up on this read
+_READ_RETRIES = 100
+
+
+def default_path(port):
+    return os.path.join(tempfile.gettempdir(), f"unity_bridge_{port}.shm")
+
+
+def _slot_size(max_hands, image_size):
+    return SLOT_HEADER.size + max_hands * HAND_RECORD.itemsize + image_size
+
+
+class ShmRingWriter:
+    """ Writes frames to the ring buffer file, one slot per frame in turn. """
+    def __init__(self, path, slots=4, max_hands=2, image_shape=None):
+        self.path = path
+        self.slots = slots
+        self.max_hands = max_hands
+        # (height, width, channels) of the pixels kept per slot, None for no image
+        self.image_shape = image_shape
+        image_size = int(np.prod(image_shape)) if image_shape else 0
+        self.slot_size = _slot_size(max_hands, image_size)
+        size = SHM_HEADER_SIZE + slots * self.slot_size
+        self._file = open(path, 'w+b')
+        self._file.truncate(size)
+        self.mm = mmap.mmap(self._file.fileno(), size)
+        image_h, image_w, channels = image_shape if image_shape else (0, 0, 0)
+        SHM_HEADER.pack_into(self.mm, 0, SHM_MAGIC, SHM_VERSION, slots, self.slot_size, max_hands,
+                             image_w, image_h, channels, 0)
+        self._hands = np.zeros(max_hands, dtype=HAND_RECORD)
+
+    def write_snapshot(self, snapshot, frame=None):
+        """ Store the hands of a FrameSnapshot ("hand_0", "hand_1", ...) and optionally its frame. """
+        data = snapshot.data
+        hands = [data[key] for key in sorted(data) if key.startswith('hand_')]
+        self.write(snapshot.seq, snapshot.timestamp, data.get('serialNumber'), hands, frame)
+
+    def write(self, seq, timestamp, serial_number, hands, frame=None):
+        hands = hands[:self.max_hands]
+        records = self._hands
+        records.fill(0)
+        records['xyz'] = np.nan
+        records['landmarks'] = np.nan
+        for record, hand in zip(records, hands):
+            record['label'] = LABELS.get(hand.get('label'), 0)
+            for field in ('lm_score', 'rotation'):
+                record[field] = np.nan if hand.get(field) is None else hand[field]
+            if hand.get('xyz') is not None:
+                record['xyz'] = np.asarray(hand['xyz'], dtype=np.float32)[:3]
+            for field in LANDMARK_FIELDS:
+                if hand.get(field) is not None:
+                    record['landmarks'] = np.asarray(hand[field], dtype=np.float32)[:NB_LANDMARKS, :3]
+                    break
+
+        image = None
+        if frame is not None and self.image_shape:
+            height, width, channels = self.image_shape
+            if frame.shape[:2] != (height, width):
+                frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+            if frame.shape == self.image_shape:
+                image = np.ascontiguousarray(frame, dtype=np.uint8)
+        image_size = 0 if image is None else image.nbytes
+
+        offset = SHM_HEADER_SIZE + (seq % self.slots) * self.slot_size
+        lock, = _LOCK.unpack_from(self.mm, offset)
+        _LOCK.pack_into(self.mm, offset, lock + 1)
+        serial = str(serial_number or '').encode('utf-8')[:32]
+        SLOT_HEADER.pack_into(self.mm, offset, lock + 1, seq, timestamp, serial, len(hands), image_size)
+        hands_offset = offset + SLOT_HEADER.size
+        self.mm[hands_offset:hands_offset + records.nbytes] = records.tobytes()
+        if image_size:
+            image_offset = hands_offset + records.nbytes
+            self.mm[image_offset:image_offset + image_size] = image.data.cast('B')
+        _LOCK.pack_into(self.mm, offset, lock + 2)
+        struct.pack_into('<Q', self.mm, _LATEST_OFFSET, seq)
+
+    def close(self):
+        self.mm.close()
+        self._file.close()
+
+
+class ShmRingReader:
+    """ Reads the latest frame from a ring buffer file written by ShmRingWriter. """
+    def __init__(self, path):
+        self._file = open(path, 'r+b')
+        self.mm = mmap.mmap(self._file.fileno(), 0)
+        magic, version, self.slots, self.slot_size, self.max_hands, image_w, image_h, channels, _ = \
+            SHM_HEADER.unpack_from(self.mm, 0)
+        if magic != SHM_MAGIC or version != SHM_VERSION:
+            raise ValueError(f"{path} is not a UnityBridge ring buffer (version {SHM_VERSION})")
+        self.image_shape = (image_h, image_w, channels) if image_w else None
+
+    def latest_seq(self):
+        return struct.unpack_from('<Q', self.mm, _LATEST_OFFSET)[0]
+
+    def read_latest(self):
+        """ The last committed frame as a dict, None if nothing was written yet. """
+        for _ in range(_READ_RETRIES):
+            seq = self.latest_seq()
+            if seq == 0:
+                return None
+            frame = self._read_slot(seq)
+            if frame is not None:
+                return frame
+        return None
+
+    def wait_for(self, after_seq=0, timeout=None, poll=0.001):
+        """ Poll until a frame newer than after_seq is committed, None on timeout. """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.latest_seq() <= after_seq:
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            time.sleep(poll)
+        return self.read_latest()
+
+    def _read_slot(self, seq):
+        offset = SHM_HEADER_SIZE + (seq % self.slots) * self.slot_size
+        lock_before, = _LOCK.unpack_from(self.mm, offset)
+        if lock_before & 1:
+            return None
+        slot = bytes(self.mm[offset:offset + self.slot_size])
+        lock_after, = _LOCK.unpack_from(self.mm, offset)
+        if lock_after != lock_before:
+            return None
+        _, slot_seq, timestamp, serial, nb_hands, image_size = SLOT_HEADER.unpack_from(slot, 0)
+        if slot_seq != seq:
+            return None
+        records = np.frombuffer(slot, dtype=HAND_RECORD, count=self.max_hands, offset=SLOT_HEADER.size)
+        hands = [{
+            "label": LABEL_NAMES.get(int(record['label'])),
+            "lm_score": float(record['lm_score']),
+            "rotation": float(record['rotation']),
+            "xyz": record['xyz'].copy(),
+            "landmarks": record['landmarks'].copy(),
+        } for record in records[:nb_hands]]
+        image = None
+        if image_size:
+            image_offset = SLOT_HEADER.size + records.nbytes
+            image = np.frombuffer(slot, dtype=np.uint8, count=image_size, offset=image_offset).reshape(self.image_shape)
+        return {
+            "seq": seq,
+            "timestamp": timestamp,
+            "serialNumber": serial.rstrip(b'\0').decode('utf-8'),
+            "hands": hands,
+            "image": image,
+        }
+
+    def close(self):
+        self.mm.close()
+        self._file.close()